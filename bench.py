@@ -0,0 +1,216 @@
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+import numpy
+
+import try3
+import main
+
+# Imported here so that importing scipy is not timed with the first sparse update
+import sparse_chain
+
+from smf import write_midi_stream, read_note_events
+from synth_midi import synth_corpus
+
+# Throughput and peak memory of the hot paths of try3.py and main.py on a
+# synthetic corpus. Results can be saved as json and compared to a previous run.
+
+def measure(function, memory=False):
+    # Seconds for one call, and the peak of traced memory of a second call
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+
+        peak = None
+        if memory:
+            tracemalloc.start()
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return result, seconds, peak
+
+def bench_corpus(file_names, orders, nb_generated, memory=False, workdir="."):
+    results = []
+
+    def record(stage, order, items, unit, seconds, peak):
+        results.append({
+            "stage": stage,
+            "order": order,
+            "files": len(file_names),
+            "items": items,
+            "unit": unit,
+            "seconds": seconds,
+            "throughput": items / seconds if seconds > 0 else float("inf"),
+            "peak_bytes": peak,
+        })
+
+    nb_events = sum(len(events) for file_name in file_names for events in read_note_events(file_name)[1])
+
+    _, seconds, peak = measure(lambda: [try3.MidiFile(file_name) for file_name in file_names], memory)
+    record("mido_decode", None, nb_events, "events/s", seconds, peak)
+
+    decoded, seconds, peak = measure(lambda: [read_note_events(file_name) for file_name in file_names], memory)
+    record("decode_notes", None, nb_events, "events/s", seconds, peak)
+
+    def pair_notes():
+        notes = []
+        for ticks_per_beat, tracks, key_signature in decoded:
+            notes += [try3.pair_notes(events, ticks_per_beat, i) for i, events in enumerate(tracks)]
+        return numpy.concatenate(notes)
+
+    notes, seconds, peak = measure(pair_notes, memory)
+    record("pair_notes", None, len(notes), "notes/s", seconds, peak)
+
+    corpus, seconds, peak = measure(lambda: [try3.read_midi(file_name) for file_name in file_names], memory)
+    nb_notes = sum(len(chords.notes) for chords in corpus)
+    record("read_midi", None, nb_notes, "notes/s", seconds, peak)
+
+    _, seconds, peak = measure(lambda: try3.notes_to_chords(notes), memory)
+    record("notes_to_chords", None, len(notes), "notes/s", seconds, peak)
+
+    for order in orders:
+        nb_transitions = sum(max(len(chords) - order, 0) for chords in corpus)
+
+        def count():
+            chain = try3.MarkovChain(order)
+            for chords in corpus:
+                chain.update(chords)
+            return chain
+
+        chain, seconds, peak = measure(count, memory)
+        record("update", order, nb_transitions, "transitions/s", seconds, peak)
+
+        def count_sparse():
+            chain = try3.SparseChain(order)
+            for chords in corpus:
+                chain.update(chords)
+            chain.flush()
+            return chain
+
+        _, seconds, peak = measure(count_sparse, memory)
+        record("sparse_update", order, nb_transitions, "transitions/s", seconds, peak)
+
+        def normalize():
+            chain.probs = {}
+            chain.duration_probs = {}
+            chain.normalize_probs()
+
+        _, seconds, peak = measure(normalize, memory)
+        record("normalize_probs", order, len(chain), "contexts/s", seconds, peak)
+
+        model, seconds, peak = measure(chain.compile, memory)
+        record("compile", order, len(chain), "contexts/s", seconds, peak)
+
+        numpy.random.seed(0)
+        piece, seconds, peak = measure(lambda: try3.create_midi_data(model, nb_generated), memory)
+        record("create_midi_data", order, nb_generated, "chords/s", seconds, peak)
+
+        _, seconds, peak = measure(lambda: try3.create_midi_batch(model, 100, nb_generated), memory)
+        record("create_midi_batch", order, 100 * nb_generated, "chords/s", seconds, peak)
+
+        file_name = os.path.join(workdir, "bench.mid")
+
+        _, seconds, peak = measure(lambda: try3.write_midi(file_name, piece, vocabulary=model.vocabulary), memory)
+        record("write_midi", order, len(piece), "chords/s", seconds, peak)
+
+        _, seconds, peak = measure(lambda: write_midi_stream(file_name, piece, vocabulary=model.vocabulary), memory)
+        record("write_midi_stream", order, len(piece), "chords/s", seconds, peak)
+
+    tracks_notes = []
+    tracks_durations = []
+    for file_name in file_names:
+        with contextlib.redirect_stdout(io.StringIO()):
+            file_notes, file_durations = main.read_midi(file_name)
+        tracks_notes += file_notes
+        tracks_durations += file_durations
+
+    def update_prob_table():
+        prob_table, duration_prob = main.init()
+        return main.update_prob_table(prob_table, duration_prob, tracks_notes, tracks_durations)
+
+    (prob_table, duration_prob), seconds, peak = measure(update_prob_table, memory)
+    nb_transitions = sum(max(len(notes) - 1, 0) for notes in tracks_notes)
+    record("main.update_prob_table", 1, nb_transitions, "transitions/s", seconds, peak)
+
+    prob_table = main.normalize_prob_table(prob_table)
+    duration_table = main.normalize_duration_table(main.to_duration_table(duration_prob))
+
+    # create_markov_midi always saves to gen/gen.mid
+    os.makedirs(os.path.join(workdir, "gen"), exist_ok=True)
+    current_directory = os.getcwd()
+    os.chdir(workdir)
+    try:
+        _, seconds, peak = measure(lambda: main.create_markov_midi("gen/gen.mid", prob_table, duration_table, nb_generated, 240), memory)
+    finally:
+        os.chdir(current_directory)
+    record("main.create_markov_midi", 1, nb_generated, "notes/s", seconds, peak)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    # Stages whose throughput dropped by more than tolerance since the baseline
+    previous = {(result["stage"], result["order"], result["files"], result["items"]): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        key = (result["stage"], result["order"], result["files"], result["items"])
+        if key in previous and result["throughput"] < previous[key]["throughput"] * (1 - tolerance):
+            regressions.append((result, previous[key]))
+
+    return regressions
+
+def print_results(results):
+    print("{:<26}{:>6}{:>7}{:>10}{:>16} {:<14}{:>12}".format("stage", "order", "files", "items", "throughput", "", "peak MB"))
+    for result in results:
+        peak = "" if result["peak_bytes"] is None else "{:.1f}".format(result["peak_bytes"] / 1e6)
+        print("{:<26}{:>6}{:>7}{:>10}{:>16.0f} {:<14}{:>12}".format(result["stage"], str(result["order"] or ""), result["files"],
+                                                                 result["items"], result["throughput"], result["unit"], peak))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20], help="numbers of files of the corpora")
+    parser.add_argument("--orders", type=int, nargs="+", default=[1, 2, 3], help="orders of the chains")
+    parser.add_argument("--notes", type=int, default=2000, help="notes per track")
+    parser.add_argument("--polyphony", type=int, default=3, help="maximum number of notes per chord")
+    parser.add_argument("--tracks", type=int, default=2, help="tracks per file")
+    parser.add_argument("--tempo", type=int, default=120, help="tempo in beats per minute")
+    parser.add_argument("--generate", type=int, default=2000, help="chords generated per piece")
+    parser.add_argument("--memory", action="store_true", help="also measure the peak memory of every stage (slower)")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="results of a previous run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="throughput drop reported as a regression")
+    args = parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            file_names = synth_corpus(os.path.join(workdir, "corpus_" + str(size)), size, nb_notes=args.notes,
+                                      polyphony=args.polyphony, nb_tracks=args.tracks, tempo=args.tempo)
+            results += bench_corpus(file_names, args.orders, args.generate, memory=args.memory, workdir=workdir)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as json_file:
+            regressions = compare(results, json.load(json_file), args.tolerance)
+
+        for result, previous in regressions:
+            print("Regression : ", result["stage"], "order", result["order"], "files", result["files"],
+                  "{:.0f} -> {:.0f} {}".format(previous["throughput"], result["throughput"], result["unit"]))
+
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,189 @@
+import time
+import argparse
+
+import numpy
+
+import try3
+import metrics
+import key
+
+from smf import write_midi_stream
+
+# Generation under constraints without retries. Tables over the states of the
+# chain (its contexts) are filled backward from the end of the piece: entry
+# [t, row] tells whether (or how likely) a piece in that state with t steps left
+# can still meet the constraints. Sampling then only picks successors whose
+# state is still good for the steps left.
+#
+# Constraints: the number of chords (exact, or between min_notes and nb_notes),
+# the chords the piece may end on, and a pitch range every note stays in.
+# Transitions to contexts the chain never saw are dead ends, the sampler does
+# not back off.
+
+class ConstrainedSampler:
+    # weighted=True keeps the probability that a free continuation meets the
+    # constraints, so pieces follow the chain conditioned on the constraints.
+    # weighted=False only keeps reachability (one byte per entry) and samples
+    # the chain renormalised over the successors that can still make it.
+    def __init__(self, model, nb_notes, end_chords=None, pitch_range=None, min_notes=None, weighted=True):
+        start_time = time.perf_counter()
+
+        with metrics.span("constraint_tables"):
+            self.model = model
+            self.order = model.order
+            self.steps = nb_notes - model.order
+            self.min_steps = self.steps if min_notes is None else max(min_notes - model.order, 0)
+            self.weighted = weighted
+
+            if self.steps < 0:
+                raise ValueError("nb_notes must be at least the order of the chain")
+            if min_notes is not None and min_notes > nb_notes:
+                raise ValueError("min_notes must be at most nb_notes")
+
+            vocabulary_size = model.vocabulary_size
+            nb_rows = len(model)
+
+            # Chords every note of which is within the pitch range
+            allowed = numpy.ones(vocabulary_size, dtype=bool)
+            if pitch_range is not None:
+                low, high = pitch_range
+                lowest, highest = model.vocabulary.note_range()
+                allowed = (lowest[:vocabulary_size] >= low) & (highest[:vocabulary_size] <= high)
+
+            accepting_chords = numpy.ones(vocabulary_size, dtype=bool)
+            if end_chords is not None:
+                accepting_chords = numpy.zeros(vocabulary_size, dtype=bool)
+                accepting_chords[list(end_chords)] = True
+
+            # Edges of the state graph: the row of every transition and the row it leads to
+            successors = numpy.asarray(model.successors, dtype=numpy.int64)
+            sources = numpy.repeat(numpy.arange(nb_rows), numpy.diff(model.indptr))
+            next_contexts = numpy.column_stack([numpy.asarray(model.contexts)[sources], successors])[:, 1:]
+            targets = model.find_rows(try3.pack_contexts(next_contexts, vocabulary_size))
+
+            weights = numpy.asarray(model.weights, dtype=numpy.float64)
+            row_totals = numpy.add.reduceat(weights, model.indptr[:-1]) if nb_rows else numpy.zeros(0)
+            probs = weights / row_totals[sources]
+            probs[(targets < 0) | ~allowed[successors]] = 0
+            self.edge_targets = targets
+            self.edge_probs = probs
+
+            last_chords = numpy.asarray(model.contexts)[:, -1] if self.order else numpy.zeros(nb_rows, dtype=numpy.int64)
+            self.accepting = accepting_chords[last_chords] & allowed[last_chords]
+
+            # tables[t, row], scaled by the largest entry of every t so that long
+            # pieces do not underflow (sampling only compares entries of one t)
+            self.tables = numpy.zeros((self.steps + 1, nb_rows), dtype=numpy.float32 if weighted else bool)
+            self.tables[0] = self.accepting
+
+            for t in range(1, self.steps + 1):
+                # A piece that may stop here stops as soon as it can
+                stops = self.accepting if self.can_stop(t) else numpy.zeros(nb_rows, dtype=bool)
+
+                next_table = self.tables[t - 1].astype(numpy.float64)
+                continuation = numpy.bincount(sources, weights=probs * next_table[numpy.maximum(targets, 0)], minlength=nb_rows)
+
+                if weighted:
+                    table = numpy.where(stops, 1.0, continuation)
+                    scale = table.max() if nb_rows else 0
+                    self.tables[t] = table / scale if scale > 0 else table
+                else:
+                    self.tables[t] = stops | (continuation > 0)
+
+            self.start_rows = numpy.flatnonzero(allowed[numpy.asarray(model.contexts)].all(axis=1) & (self.tables[self.steps] > 0))
+
+        self.report = {
+            "seconds": time.perf_counter() - start_time,
+            "table_bytes": self.tables.nbytes + self.edge_targets.nbytes + self.edge_probs.nbytes,
+            "states": nb_rows,
+            "edges": len(self.edge_probs),
+            "steps": self.steps,
+            "feasible_starts": len(self.start_rows),
+        }
+        metrics.count("constraint_table_bytes", self.report["table_bytes"])
+
+    def can_stop(self, steps_left):
+        return self.steps - steps_left >= self.min_steps
+
+    def sample(self, random_state=numpy.random):
+        # Chord ids of a piece meeting the constraints, ValueError when none can
+        if len(self.start_rows) == 0:
+            raise ValueError("No piece of the chain meets the constraints")
+
+        with metrics.span("sample"):
+            model = self.model
+
+            # Start contexts are drawn uniformly like create_midi_data, weighted
+            # by their chance of success
+            start_weights = self.tables[self.steps, self.start_rows].astype(numpy.float64)
+            row = self.start_rows[choose(start_weights, random_state.random_sample())]
+            generated_chords = model.contexts[row].tolist()
+
+            for t in range(self.steps, 0, -1):
+                if self.accepting[row] and self.can_stop(t):
+                    break
+
+                start, end = model.indptr[row], model.indptr[row + 1]
+                targets = self.edge_targets[start:end]
+                weights = self.edge_probs[start:end] * self.tables[t - 1, numpy.maximum(targets, 0)]
+
+                column = choose(weights, random_state.random_sample())
+                generated_chords.append(int(model.successors[start + column]))
+                row = targets[column]
+
+        metrics.count("generated_chords", len(generated_chords))
+
+        return generated_chords
+
+def choose(weights, u):
+    cumulative = numpy.cumsum(weights)
+    return min(int(cumulative.searchsorted(u * cumulative[-1], side="right")), len(weights) - 1)
+
+def chords_with_root(vocabulary, pitch_class):
+    # Ids of the chords whose lowest note has this pitch class
+    lowest, highest = vocabulary.note_range()
+    return numpy.flatnonzero(lowest % 12 == pitch_class).tolist()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="directory of a saved chain (try3.py --save)")
+    parser.add_argument("--notes", type=int, default=100, help="number of chords of the piece")
+    parser.add_argument("--min-notes", type=int, help="let the piece end as soon as it can after this many chords")
+    parser.add_argument("--end-root", help="pitch class of the lowest note of the last chord, e.g. C or A")
+    parser.add_argument("--low", type=int, help="lowest midi note allowed")
+    parser.add_argument("--high", type=int, help="highest midi note allowed")
+    parser.add_argument("--reachability", action="store_true", help="one byte per table entry instead of probabilities")
+    parser.add_argument("--pieces", type=int, default=1, help="number of pieces to generate")
+    parser.add_argument("--seed", type=int, help="seed of the generation")
+    parser.add_argument("--output", default="gen/constrained", help="prefix of the generated midi files")
+    parser.add_argument("--verbose", action="store_true", help="print progress messages")
+    parser.add_argument("--metrics", help="save timings and counters to this json file")
+    args = parser.parse_args()
+
+    metrics.set_verbose(args.verbose)
+    metrics.enable(args.metrics is not None)
+
+    model = try3.load_chain(args.model)
+
+    end_chords = chords_with_root(model.vocabulary, key.parse_key(args.end_root)[0]) if args.end_root else None
+    pitch_range = None
+    if args.low is not None or args.high is not None:
+        pitch_range = (0 if args.low is None else args.low, 127 if args.high is None else args.high)
+
+    try:
+        sampler = ConstrainedSampler(model, args.notes, end_chords=end_chords, pitch_range=pitch_range, min_notes=args.min_notes,
+                                     weighted=not args.reachability)
+    except ValueError as err:
+        parser.error(str(err))
+    print("Tables : {steps} steps x {states} states, {edges} edges, {table_bytes} bytes in {seconds:.3f} s, {feasible_starts} feasible starts".format(**sampler.report))
+    if len(sampler.start_rows) == 0:
+        parser.error("no piece of " + str(args.notes) + " chords of this chain meets the constraints")
+
+    random_state = numpy.random.RandomState(args.seed)
+    for i in range(args.pieces):
+        piece = sampler.sample(random_state)
+        write_midi_stream(args.output + str(i) + ".mid", piece, vocabulary=model.vocabulary, ticks_per_beat=try3.TICKS_PER_BEAT)
+        metrics.log("Piece : ", i, len(piece), "chords")
+
+    if args.metrics:
+        metrics.save_report(args.metrics)
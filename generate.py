@@ -0,0 +1,116 @@
+import collections
+
+import numpy
+
+import metrics
+
+# Sampling of pieces from a try3.CompiledChain, one at a time, lazily, or in a
+# batch. Pieces are lists of chord ids, decoded into notes when written.
+
+def create_midi_data(markov_chain, nb_notes=100, backoff_depths=None, random_state=numpy.random):
+    # markov_chain is a CompiledChain. Generation works on chord ids only, they
+    # are decoded into notes by write_midi. When a context was never seen the
+    # chain backs off to its longest seen suffix. If backoff_depths is a list of
+    # order + 1 counters, backoff_depths[d] counts the steps that dropped d chords.
+    # random_state is a numpy.random.RandomState for seeded generation.
+    with metrics.span("sample"):
+        order = markov_chain.order
+        uniforms = random_state.random_sample(nb_notes)
+
+        # choose a random context (number of the markov chain order) for the start of the midi
+        generated_chords = markov_chain.contexts[random_state.randint(len(markov_chain))].tolist()
+        backoff_misses = 0
+
+        for i in range(order, nb_notes):
+            chain, row, depth = markov_chain.find_backoff_row(generated_chords[i - order:i])
+
+            generated_chords.append(chain.sample(row, uniforms[i]))
+
+            if depth > 0:
+                backoff_misses += 1
+            if backoff_depths is not None:
+                backoff_depths[depth] += 1
+
+    metrics.count("generated_chords", len(generated_chords))
+    metrics.count("backoff_misses", backoff_misses)
+
+    return generated_chords
+
+def generate_chords(markov_chain, nb_notes=None, backoff_depths=None, random_state=numpy.random, lookahead=64, start=None):
+    # Lazy create_midi_data: yields the chord ids one at a time, forever when
+    # nb_notes is None. Only the last order chords and a block of lookahead
+    # uniform numbers are kept, so memory does not grow with the piece. start
+    # is a list of chords (at least order) the piece begins with instead of a
+    # random context.
+    order = markov_chain.order
+    if start is None:
+        start = markov_chain.contexts[random_state.randint(len(markov_chain))].tolist()
+    context = collections.deque(start, maxlen=order)
+
+    metrics.count("generated_chords", len(start))
+    for chord in start:
+        yield chord
+
+    i = len(start)
+    uniforms = []
+    while nb_notes is None or i < nb_notes:
+        if not uniforms:
+            uniforms = random_state.random_sample(lookahead).tolist()[::-1]
+
+        with metrics.span("sample"):
+            chain, row, depth = markov_chain.find_backoff_row(list(context))
+            chord = chain.sample(row, uniforms.pop())
+
+        if depth > 0:
+            metrics.count("backoff_misses")
+        if backoff_depths is not None:
+            backoff_depths[depth] += 1
+        metrics.count("generated_chords")
+
+        context.append(chord)
+        i += 1
+        yield chord
+
+def create_midi_batch(markov_chain, nb_pieces, nb_notes=100, backoff_depths=None, random_state=numpy.random):
+    # Same as create_midi_data for nb_pieces independent sequences at once, every
+    # step does one lookup and one draw for the whole batch (plus one per
+    # backoff level for the pieces whose context was never seen)
+    with metrics.span("sample"):
+        order = markov_chain.order
+        uniforms = random_state.random_sample((nb_notes, nb_pieces))
+
+        generated_chords = numpy.empty((nb_pieces, nb_notes), dtype=numpy.int64)
+        start_rows = random_state.randint(len(markov_chain), size=nb_pieces)
+        generated_chords[:, :order] = markov_chain.contexts[start_rows]
+
+        backoff_misses = 0
+
+        for i in range(order, nb_notes):
+            rows = markov_chain.find_context_rows(generated_chords[:, i - order:i])
+            missing = numpy.flatnonzero(rows < 0)
+            backoff_misses += len(missing)
+
+            next_chords = markov_chain.sample_rows(numpy.maximum(rows, 0), uniforms[i])
+
+            if backoff_depths is not None:
+                backoff_depths[0] += nb_pieces - len(missing)
+
+            for depth, chain in enumerate(markov_chain.backoff, 1):
+                if len(missing) == 0:
+                    break
+
+                rows = chain.find_context_rows(generated_chords[missing, i - chain.order:i])
+                found = rows >= 0
+
+                next_chords[missing[found]] = chain.sample_rows(rows[found], uniforms[i, missing[found]])
+                missing = missing[~found]
+
+                if backoff_depths is not None:
+                    backoff_depths[depth] += int(found.sum())
+
+            generated_chords[:, i] = next_chords
+
+    metrics.count("generated_chords", nb_pieces * nb_notes)
+    metrics.count("backoff_misses", backoff_misses)
+
+    return generated_chords.tolist()
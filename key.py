@@ -0,0 +1,62 @@
+import numpy
+
+# Key detection and transposition. Files are transposed at ingest so that major
+# keys become C major and minor keys A minor, then generated pieces are
+# transposed back to the key asked for.
+
+PITCH_CLASSES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+# Krumhansl-Kessler key profiles, tonic first
+MAJOR_PROFILE = numpy.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = numpy.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+def standardize(values):
+    values = values - values.mean(axis=-1, keepdims=True)
+    norms = numpy.linalg.norm(values, axis=-1, keepdims=True)
+    return values / numpy.where(norms > 0, norms, 1)
+
+# Row 12 * mode + tonic is the profile of that key (mode 0 is major, 1 minor)
+KEY_PROFILES = standardize(numpy.array([numpy.roll(profile, tonic) for profile in (MAJOR_PROFILE, MINOR_PROFILE) for tonic in range(12)]))
+
+def parse_key(name):
+    # "C", "F#", "Bb", "Am", "C#m" (the names used by mido key_signature messages)
+    # to (tonic pitch class, is minor)
+    minor = name.endswith("m")
+    if minor:
+        name = name[:-1]
+
+    tonic = PITCH_CLASSES[name[0].upper()]
+    for accidental in name[1:]:
+        if accidental == "#":
+            tonic += 1
+        elif accidental == "b":
+            tonic -= 1
+        else:
+            raise ValueError("Unknown key : " + name)
+
+    return tonic % 12, minor
+
+def detect_key(pitches, durations=None):
+    # Key whose profile correlates best with the (duration weighted) pitch class
+    # histogram, scored against the 24 keys at once
+    histogram = numpy.bincount(numpy.asarray(pitches) % 12, weights=durations, minlength=12).astype(numpy.float64)
+    scores = KEY_PROFILES @ standardize(histogram)
+    best = int(numpy.argmax(scores))
+    return best % 12, best >= 12
+
+def wrap_shift(shift):
+    # Semitones in [-6, 5], so that no note moves by more than half an octave
+    return (shift + 6) % 12 - 6
+
+def shift_to_canonical(tonic, minor):
+    # Semitones taking the key to C major or A minor
+    return wrap_shift((9 if minor else 0) - tonic)
+
+def shift_from_canonical(tonic, minor):
+    return -shift_to_canonical(tonic, minor)
+
+def transpose(pitches, shift):
+    # Pitches pushed out of the midi range are moved back by an octave
+    pitches = numpy.asarray(pitches) + shift
+    pitches = numpy.where(pitches < 0, pitches + 12, pitches)
+    return numpy.where(pitches > 127, pitches - 12, pitches)
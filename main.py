@@ -1,25 +1,21 @@
 from mido import MidiFile, MidiTrack, Message
-import random
 import numpy
+import bisect
 import glob
+import argparse
+import os
+
+from multiprocessing import Pool
+
+import metrics
+
+from smf import read_note_events
 
 def init():
-    
-    prob_table = {
-        0: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        1: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        2: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        3: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        4: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        5: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        6: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        7: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        8: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        9: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        10: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        11: [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    }
-    duration_prob = {}
+    # Transition counts between the 12 pitch classes, and the (durations, counts)
+    # histogram of the delta times
+    prob_table = numpy.zeros((12, 12), dtype=numpy.int64)
+    duration_prob = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
     return prob_table, duration_prob
 
 def print_midi(file):
@@ -30,70 +26,117 @@ def print_midi(file):
             print(msg)
 
 def read_midi(file):
-    midi = MidiFile(file)
-    print("Ticks per beat: ", midi.ticks_per_beat)
-    tracks_notes = []
-    tracks_durations = []
-    
-    for i, track in enumerate(midi.tracks):
-        print('Track {}: {}'.format(i, track.name))
-        notes = []
-        durations = []
-        for msg in track:
-            # print(msg)
-            if not msg.is_meta and msg.type == "note_on" or msg.type == "note_off":
-                # print(msg)
-                notes.append(int(msg.note))
-                durations.append(int(msg.time))
-            elif msg.type == "key_signature":
-                print("Key signature: ", msg)
-        if len(notes) > 1:
-            tracks_notes.append(notes)
-            tracks_durations.append(durations)
-    print("Nb of tracks : ", len(tracks_notes))
+    with metrics.span("parse"):
+        ticks_per_beat, tracks, key_signature = read_note_events(file)
+        metrics.log("Ticks per beat: ", ticks_per_beat)
+        if key_signature is not None:
+            metrics.log("Key signature: ", key_signature)
+
+        # Pitch and delta time of every note_on and note_off
+        tracks_notes = [events["pitch"].astype(numpy.int64) for events in tracks if len(events) > 1]
+        tracks_durations = [events["delta"] for events in tracks if len(events) > 1]
+        metrics.log("Nb of tracks : ", len(tracks_notes))
+
+    metrics.count("files")
+    metrics.count("notes", sum(len(notes) for notes in tracks_notes))
     return tracks_notes, tracks_durations
 
+def merge_histograms(histogram, other_histogram):
+    values, inverse = numpy.unique(numpy.concatenate([histogram[0], other_histogram[0]]), return_inverse=True)
+    counts = numpy.bincount(inverse, weights=numpy.concatenate([histogram[1], other_histogram[1]]), minlength=len(values))
+    return values, counts.astype(numpy.int64)
+
+def duration_histogram(tracks_durations):
+    durations = numpy.concatenate([numpy.asarray(durations, dtype=numpy.int64) for durations in tracks_durations] +
+                                  [numpy.zeros(0, dtype=numpy.int64)])
+    return numpy.unique(durations, return_counts=True)
+
 def update_prob_table(prob_table, duration_prob, tracks_notes, tracks_durations):
-    for notes in tracks_notes:
-        for i in range(1, len(notes)):
-            note = notes[i]
-            prev_note = notes[i - 1]
-            if prev_note in prob_table:
-                prob_table[prev_note][note] += 1
-            else:
-                prob_table[prev_note][note] = 1
-    
-    for durations in tracks_durations:
-        for duration in durations:
-            if duration in duration_prob:
-                duration_prob[duration] += 1
-            else:
-                duration_prob[duration] = 1
+    # Notes are folded to their pitch class to index the 12 rows of the table.
+    # prob_table is updated in place, the updated duration histogram is returned.
+    with metrics.span("count"):
+        for notes in tracks_notes:
+            pitch_classes = numpy.asarray(notes, dtype=numpy.int64) % 12
+            numpy.add.at(prob_table, (pitch_classes[:-1], pitch_classes[1:]), 1)
+
+        duration_prob = merge_histograms(duration_prob, duration_histogram(tracks_durations))
+
+    metrics.count("transitions", sum(max(len(notes) - 1, 0) for notes in tracks_notes))
+
+    return prob_table, duration_prob
+
+def merge_prob_tables(prob_table, duration_prob, other_prob_table, other_duration_prob):
+    prob_table += other_prob_table
+    return prob_table, merge_histograms(duration_prob, other_duration_prob)
 
-    duration_prob.pop(0, None)
+def to_duration_table(duration_prob):
+    # Delta times of 0 are the notes of a chord after the first one
+    values, counts = duration_prob
+    keep = values != 0
+    return [values[keep], counts[keep]]
 
-    durations = list(duration_prob.keys())
-    duration_probs = list(duration_prob.values())
-    duration_table = [durations, duration_probs]
+def count_midi_file(args):
+    # Runs in a worker process, the metrics of the file are sent back with its counts
+    file, metrics_enabled = args
+    metrics.enable(metrics_enabled)
+    metrics.reset()
 
-    return prob_table, duration_table
+    prob_table, duration_prob = init()
+    tracks_notes, tracks_durations = read_midi(file)
+    prob_table, duration_prob = update_prob_table(prob_table, duration_prob, tracks_notes, tracks_durations)
+    return prob_table, duration_prob, metrics.report()
+
+def train(files, jobs=1):
+    prob_table, duration_prob = init()
+
+    if jobs == 1:
+        for i, file in enumerate(files):
+            metrics.log("\n-------- Midi {} ---------\n".format(i))
+            tracks_notes, tracks_durations = read_midi(file)
+            prob_table, duration_prob = update_prob_table(prob_table, duration_prob, tracks_notes, tracks_durations)
+    else:
+        # Each worker counts a file in its own tables, they are summed in file order
+        with Pool(jobs) as pool:
+            for other_prob_table, other_duration_prob, other_metrics in pool.imap(count_midi_file, [(file, metrics.enabled) for file in files]):
+                prob_table, duration_prob = merge_prob_tables(prob_table, duration_prob, other_prob_table, other_duration_prob)
+                metrics.merge(other_metrics)
+
+    return prob_table, to_duration_table(duration_prob)
+
+def train_sparse(files):
+    # Same as train with the note transitions counted in a scipy.sparse matrix.
+    # Notes are folded to their pitch class so they index the 12 rows of the table.
+    from sparse_chain import transition_matrix, normalize_rows
+
+    sequences = []
+    duration_prob = init()[1]
+
+    for i, file in enumerate(files):
+        metrics.log("\n-------- Midi {} ---------\n".format(i))
+        tracks_notes, tracks_durations = read_midi(file)
+        sequences += [numpy.asarray(notes, dtype=numpy.int64) % 12 for notes in tracks_notes]
+        duration_prob = merge_histograms(duration_prob, duration_histogram(tracks_durations))
+
+    # Rows are already normalized, normalize_prob_table leaves them as they are
+    prob_table = normalize_rows(transition_matrix(sequences, 12)).toarray()
+
+    return prob_table, to_duration_table(duration_prob)
 
 def print_prob_table(prob_table):
     print("A\tA#\tB\tC\tC#\tD\tD#\tE\tF\tF#\tG\tG#")
     for row in prob_table:
-        row_str = ""
-        for prob in prob_table[row]:
-            row_str += str(round(prob, 2)) + "\t"
-        print(row_str)
+        print("".join(str(round(prob, 2)) + "\t" for prob in row.tolist()))
 
 def normalize_prob_table(prob_table):
-    for note in range(len(prob_table)):
-
-        prob_table[note] = [float(i)/sum(prob_table[note]) if sum(prob_table[note]) > 0 else 0 for i in prob_table[note]]
+    # Rows that never occur stay at 0
+    with metrics.span("normalize"):
+        totals = prob_table.sum(axis=1, keepdims=True)
+        prob_table = numpy.divide(prob_table, totals, out=numpy.zeros(prob_table.shape), where=totals > 0)
     return prob_table
 
 def normalize_duration_table(duration_table):
-    duration_table[1] = [dur/sum(duration_table[1]) for dur in duration_table[1]]
+    counts = numpy.asarray(duration_table[1], dtype=numpy.float64)
+    duration_table[1] = counts / counts.sum()
     return duration_table
 
 def create_markov_midi(path, prob_table, duration_table, nb_notes, speed, tracks=1, instrument=0):
@@ -101,6 +144,13 @@ def create_markov_midi(path, prob_table, duration_table, nb_notes, speed, tracks
     new_song = MidiFile()
     new_song.ticks_per_beat = speed
 
+    # Cumulative distributions sampled with searchsorted. A pitch class that is
+    # never followed by anything continues with the overall note distribution.
+    cumulative_probs = numpy.cumsum(prob_table, axis=1)
+    empty_rows = cumulative_probs[:, -1] <= 0
+    cumulative_probs[empty_rows] = numpy.cumsum(prob_table.sum(axis=0))
+    cumulative_durations = numpy.cumsum(duration_table[1])
+
     for i in range(tracks):
         track = MidiTrack()
         new_song.tracks.append(track)
@@ -109,31 +159,60 @@ def create_markov_midi(path, prob_table, duration_table, nb_notes, speed, tracks
         track.append(Message('control_change', channel=0, control=10, value=64, time=0))
 
         base_tone = 72
-        first_note = random.randint(0, 12)
+        first_note = int(numpy.random.randint(12))
         track.append(Message('note_on', note=first_note + base_tone, velocity=100, time=0))
         track.append(Message('note_off', note=first_note + base_tone, velocity=0, time=120))
 
-        prev_note = first_note
-        for i in range(nb_notes):
-            next_note = numpy.random.choice(range(0, 12), p=prob_table[prev_note])
-            note_duration = numpy.random.choice(duration_table[0], p=duration_table[1])
-            track.append(Message('note_on', note=next_note + base_tone, velocity=100, time=0))
-            track.append(Message('note_off', note=next_note + base_tone, velocity=0, time=note_duration))
-            prev_note = next_note
+        with metrics.span("sample"):
+            # Every draw of the piece is made up front, durations do not depend
+            # on the notes so they are all looked up at once
+            note_uniforms = numpy.random.random(nb_notes).tolist()
+            duration_uniforms = numpy.random.random(nb_notes) * cumulative_durations[-1]
+            duration_indices = numpy.minimum(numpy.searchsorted(cumulative_durations, duration_uniforms, side="right"), len(cumulative_durations) - 1)
+            note_durations = numpy.asarray(duration_table[0])[duration_indices].tolist()
 
-    new_song.save("gen/gen.mid")
+            # Each note depends on the previous one, the 12 rows are bisected as lists
+            rows = cumulative_probs.tolist()
+            next_notes = []
+            prev_note = first_note
+            for u in note_uniforms:
+                row = rows[prev_note]
+                prev_note = min(bisect.bisect_right(row, u * row[-1]), 11)
+                next_notes.append(prev_note)
 
-if __name__ == "__main__":
-    prob_table, duration_prob = init()
+            for next_note, note_duration in zip(next_notes, note_durations):
+                track.append(Message('note_on', note=next_note + base_tone, velocity=100, time=0))
+                track.append(Message('note_off', note=next_note + base_tone, velocity=0, time=note_duration))
 
-    for i, file in enumerate(glob.glob("data/fp-1all.mid")):
-        print("\n-------- Midi {} ---------\n".format(i))
-        # print_midi(file)
-        tracks_notes, tracks_durations = read_midi(file)
-        prob_table, duration_table = update_prob_table(prob_table, duration_prob, tracks_notes, tracks_durations)
+        metrics.count("generated_notes", nb_notes)
+
+    with metrics.span("write"):
+        new_song.save("gen/gen.mid")
+
+    metrics.count("bytes_written", os.path.getsize("gen/gen.mid"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", default="data/fp-1all.mid", help="glob of the midi files to train on")
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes used to read the midi files")
+    parser.add_argument("--sparse", action="store_true", help="count the transitions in a scipy.sparse matrix")
+    parser.add_argument("--verbose", action="store_true", help="print progress messages")
+    parser.add_argument("--metrics", help="save timings and counters to this json file")
+    args = parser.parse_args()
+
+    metrics.set_verbose(args.verbose)
+    metrics.enable(args.metrics is not None)
+
+    if args.sparse:
+        prob_table, duration_table = train_sparse(glob.glob(args.files))
+    else:
+        prob_table, duration_table = train(glob.glob(args.files), jobs=args.jobs)
 
     prob_table = normalize_prob_table(prob_table)
     duration_table = normalize_duration_table(duration_table)
     create_markov_midi("gen/gen.mid", prob_table, duration_table, 100, 240, tracks=1)
     
     print_prob_table(prob_table)
+
+    if args.metrics:
+        metrics.save_report(args.metrics)
@@ -0,0 +1,98 @@
+import sys
+import json
+import time
+import threading
+
+# Timing spans and counters for the ingest and generation pipeline. Everything is
+# off by default: span() then returns a shared no-op object and count() returns
+# right away, so the instrumented code pays about one function call. Updates
+# take a lock, the generation server records them from its worker threads.
+
+enabled = False
+verbose = False
+
+timings = {}
+counters = {}
+lock = threading.Lock()
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+def set_verbose(flag=True):
+    global verbose
+    verbose = flag
+
+def reset():
+    with lock:
+        timings.clear()
+        counters.clear()
+
+def log(*args):
+    # Progress messages, printed only in verbose mode
+    if verbose:
+        print(*args, file=sys.stderr)
+
+def count(name, value=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + value
+
+def add_time(name, seconds):
+    if enabled:
+        with lock:
+            timing = timings.get(name)
+            if timing is None:
+                timings[name] = [1, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.perf_counter() - self.start)
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_SPAN = NoSpan()
+
+def span(name):
+    if enabled:
+        return Span(name)
+    return NO_SPAN
+
+def report():
+    with lock:
+        return {
+            "timings": {name: {"count": timing[0], "seconds": timing[1]} for name, timing in timings.items()},
+            "counters": dict(counters),
+        }
+
+def merge(other_report):
+    # Add a report from another process (see try3.count_midi_file)
+    with lock:
+        for name, timing in other_report["timings"].items():
+            if name in timings:
+                timings[name][0] += timing["count"]
+                timings[name][1] += timing["seconds"]
+            else:
+                timings[name] = [timing["count"], timing["seconds"]]
+
+        for name, value in other_report["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+
+def save_report(file_name):
+    with open(file_name, "w") as json_file:
+        json.dump(report(), json_file, indent=2)
@@ -0,0 +1,184 @@
+import glob
+import argparse
+
+import numpy
+
+import try3
+import metrics
+
+# Counts of every order 1..max_order from a single read of the corpus, and the
+# held-out perplexity of each order to pick one. The chord ids of every file
+# are kept once, the n-grams of each order are windows over the same arrays.
+
+class NgramCounts:
+    def __init__(self, max_order, vocabulary=None):
+        self.max_order = max_order
+        self.vocabulary = try3.Vocabulary() if vocabulary is None else vocabulary
+        self.sequences = []
+        self.tables = None
+
+    def update(self, chords):
+        with metrics.span("count"):
+            chord_ids = [self.vocabulary.intern(chord_key) for chord_key in try3.chords_to_keys(chords)]
+            self.sequences.append(numpy.array(chord_ids, dtype=numpy.int64))
+            self.tables = None
+
+    def base(self):
+        # Keys are packed in base V + 1, the extra id stands for the chords of
+        # held-out files that are not in the vocabulary
+        return len(self.vocabulary) + 1
+
+    def count(self):
+        # tables[n] is (sorted unique keys of the (n + 1)-grams, their rows of
+        # chord ids, counts), the unigrams for n = 0. The keys are packed by
+        # try3.pack_contexts, which falls back to byte keys for vocabularies
+        # too large to pack the n-grams in an int64.
+        if self.tables is not None:
+            return self.tables
+
+        with metrics.span("count"):
+            base = self.base()
+
+            self.tables = []
+            for order in range(self.max_order + 1):
+                rows = numpy.concatenate([windows(sequence, order + 1) for sequence in self.sequences if len(sequence) > order] +
+                                         [numpy.zeros((0, order + 1), dtype=numpy.int32)])
+                keys, index, counts = numpy.unique(try3.pack_contexts(rows, base), return_index=True, return_counts=True)
+                self.tables.append((keys, rows[index], counts))
+
+        return self.tables
+
+    def compile(self, order):
+        # CompiledChain of one order, with the tables of the lower orders as its
+        # backoff chains, to generate from. The rows sort like their keys, so
+        # they are the sorted transitions.
+        tables = self.count()
+
+        durations = (numpy.zeros((0, order), dtype=numpy.int32), numpy.zeros(1, dtype=numpy.int64),
+                     numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int64))
+
+        def table_chain(k):
+            transition_keys, transitions, counts = tables[k]
+            return try3.transitions_to_chain(k, self.vocabulary, transitions, counts.astype(numpy.int64), durations)
+
+        with metrics.span("compile"):
+            model = table_chain(order)
+            model.backoff = [table_chain(k) for k in range(order - 1, -1, -1)]
+        return model
+
+    def encode(self, chords):
+        # Chord ids of a held-out file, V for chords never seen in training
+        oov = len(self.vocabulary)
+        return numpy.array([self.vocabulary.ids.get(chord_key, oov) for chord_key in try3.chords_to_keys(chords)], dtype=numpy.int64)
+
+    def log_probabilities(self, sequences, order):
+        # Natural log of the probability of every chord from position max_order
+        # on, given its order previous chords. Witten-Bell interpolation from an
+        # add-one unigram distribution over V + 1 chords up to the given order,
+        # so unseen contexts and chords keep a non-zero probability.
+        tables = self.count()
+        base = self.base()
+        start = self.max_order
+
+        sequences = [sequence for sequence in sequences if len(sequence) > start]
+        if not sequences:
+            return numpy.zeros(0)
+
+        nexts = numpy.concatenate([sequence[start:] for sequence in sequences])[:, None]
+
+        unigram_keys, unigrams, unigram_counts = tables[0]
+        counts = lookup(unigram_keys, unigram_counts, try3.pack_contexts(nexts, base))
+        probs = (counts + 1) / (unigram_counts.sum() + base)
+
+        for n in range(1, order + 1):
+            transition_keys, transitions, transition_counts = tables[n]
+            context_keys, context_totals, context_types = context_statistics(transitions, transition_counts, base)
+
+            contexts = numpy.concatenate([windows(sequence[start - n:-1], n) for sequence in sequences])
+            context_queries = try3.pack_contexts(contexts, base)
+            totals = lookup(context_keys, context_totals, context_queries)
+            types = lookup(context_keys, context_types, context_queries)
+            counts = lookup(transition_keys, transition_counts, try3.pack_contexts(numpy.hstack([contexts, nexts]), base))
+
+            seen = totals > 0
+            probs = numpy.where(seen, (counts + types * probs) / numpy.maximum(totals + types, 1), probs)
+
+        return numpy.log(probs)
+
+    def score(self, sequences, orders=None):
+        # {order: (log likelihood, perplexity)} of held-out chord id sequences,
+        # every order scoring the same chords
+        if orders is None:
+            orders = range(1, self.max_order + 1)
+
+        scores = {}
+        with metrics.span("score"):
+            for order in orders:
+                log_probs = self.log_probabilities(sequences, order)
+                log_likelihood = float(log_probs.sum())
+                perplexity = float(numpy.exp(-log_probs.mean())) if len(log_probs) else float("nan")
+                scores[order] = (log_likelihood, perplexity)
+        return scores
+
+def windows(sequence, length):
+    # (len(sequence) - length + 1, length) array of every window of length chords
+    return numpy.lib.stride_tricks.sliding_window_view(sequence, length).astype(numpy.int32)
+
+def lookup(keys, values, queries):
+    # values of the queries in the sorted keys, 0 for missing ones
+    if len(keys) == 0:
+        return numpy.zeros(len(queries), dtype=values.dtype)
+    index = numpy.minimum(keys.searchsorted(queries), len(keys) - 1)
+    return numpy.where(keys[index] == queries, values[index], 0)
+
+def context_statistics(transitions, counts, base):
+    # Sorted context keys, with the total count and the number of distinct
+    # successors of every context
+    context_keys = try3.pack_contexts(transitions[:, :-1], base)
+    row_starts = numpy.flatnonzero(numpy.concatenate([[len(context_keys) > 0], context_keys[1:] != context_keys[:-1]]))
+    totals = numpy.add.reduceat(counts, row_starts) if len(row_starts) else numpy.zeros(0, dtype=counts.dtype)
+    types = numpy.diff(numpy.append(row_starts, len(context_keys)))
+    return context_keys[row_starts], totals, types
+
+def best_order(scores):
+    return min(scores, key=lambda order: scores[order][1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", required=True, help="glob of the midi files to train on")
+    parser.add_argument("--held-out", required=True, help="glob of the midi files to score the orders on")
+    parser.add_argument("--max-order", type=int, default=4, help="highest order counted")
+    parser.add_argument("--chord-window", type=int, default=0, help="notes starting at most this many ticks (at 10 per beat) after the first note of a chord join it")
+    parser.add_argument("--normalize-key", action="store_true", help="transpose every file to C major / A minor before counting")
+    parser.add_argument("--save", help="directory to save the chain of the best order to")
+    parser.add_argument("--verbose", action="store_true", help="print progress messages")
+    parser.add_argument("--metrics", help="save timings and counters to this json file")
+    args = parser.parse_args()
+
+    metrics.set_verbose(args.verbose)
+    metrics.enable(args.metrics is not None)
+
+    file_names = glob.glob(args.files)
+    held_out_names = glob.glob(args.held_out)
+    if not file_names or not held_out_names:
+        parser.error("no midi file matches --files or --held-out")
+
+    ngrams = NgramCounts(args.max_order)
+    for file_name in file_names:
+        ngrams.update(try3.read_midi(file_name, args.chord_window, args.normalize_key))
+
+    held_out = [ngrams.encode(try3.read_midi(file_name, args.chord_window, args.normalize_key)) for file_name in held_out_names]
+
+    scores = ngrams.score(held_out)
+    print("order  log likelihood  perplexity")
+    for order, (log_likelihood, perplexity) in scores.items():
+        print("{:>5}{:>16.1f}{:>12.2f}".format(order, log_likelihood, perplexity))
+
+    order = best_order(scores)
+    print("Best order : ", order)
+
+    if args.save:
+        ngrams.compile(order).save(args.save)
+
+    if args.metrics:
+        metrics.save_report(args.metrics)
@@ -0,0 +1,158 @@
+import os
+import copy
+import json
+import zlib
+import zipfile
+import hashlib
+import tempfile
+
+import numpy
+
+# On-disk cache of parsed midi files. Entries are keyed by the content hash of
+# the file and the parsing parameters, so a new chain order or a retrain on the
+# same corpus does not decode the files again. The hash of a file is itself
+# cached by path, and reused while the size and mtime of the file are unchanged.
+# Entries and hashes share the size bound and are evicted least recently used
+# first.
+
+# Bump when the parsed arrays change for the same file and parameters
+CACHE_VERSION = 2
+
+class ParseCache:
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Running total of the files in the cache, None until the first scan
+        self.size = None
+
+        os.makedirs(os.path.join(directory, "entries"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "hashes"), exist_ok=True)
+
+    def content_hash(self, file_name):
+        stat = os.stat(file_name)
+        path = os.path.abspath(file_name)
+        hash_file = os.path.join(self.directory, "hashes", hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+        try:
+            with open(hash_file) as json_file:
+                known = json.load(json_file)
+            if known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                os.utime(hash_file)
+                return known["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = hashlib.sha256()
+        with open(file_name, "rb") as midi_file:
+            for block in iter(lambda: midi_file.read(1 << 20), b""):
+                digest.update(block)
+
+        content_hash = digest.hexdigest()
+        self.write_atomic(hash_file, json.dumps({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash}).encode())
+        self.added(hash_file)
+        return content_hash
+
+    def entry_path(self, file_name, params):
+        key = str(CACHE_VERSION) + ":" + self.content_hash(file_name) + ":" + repr(params)
+        return os.path.join(self.directory, "entries", hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+    def get(self, file_name, params, names=()):
+        # Dict of the arrays stored for this file and parameters, None on a
+        # miss. An entry that cannot be read or lacks one of names is removed
+        # and counts as a miss.
+        path = self.entry_path(file_name, params)
+        try:
+            with numpy.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile, zlib.error):
+            self.discard(path)
+            return None
+
+        if not set(names) <= set(arrays):
+            self.discard(path)
+            return None
+
+        # The mtime of an entry is its last use, for the eviction
+        os.utime(path)
+        return arrays
+
+    def put(self, file_name, params, **arrays):
+        path = self.entry_path(file_name, params)
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as entry_file:
+            numpy.savez(entry_file, **arrays)
+        os.replace(entry_file.name, path)
+
+        self.added(path)
+
+    def added(self, path):
+        # The directories are only scanned again once the running total goes
+        # over the bound, and eviction goes down to 90% of it so that the next
+        # scan is many files away
+        if self.max_bytes is None:
+            return
+
+        if self.size is None:
+            self.size = sum(size for mtime, size, path in self.scan())
+        else:
+            self.size += os.path.getsize(path)
+
+        if self.size > self.max_bytes:
+            self.evict(self.max_bytes * 9 // 10)
+
+    def discard(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        if self.size is not None:
+            self.size -= size
+
+    def deferred(self):
+        # Copy for worker processes, which cannot share the running total: its
+        # puts never evict, the owner calls evict once the workers are done
+        cache = copy.copy(self)
+        cache.max_bytes = None
+        return cache
+
+    def scan(self):
+        # (mtime, size, path) of every entry and hash file
+        files = []
+        for subdirectory, extension in (("entries", ".npz"), ("hashes", ".json")):
+            for name in os.listdir(os.path.join(self.directory, subdirectory)):
+                if name.endswith(extension):
+                    path = os.path.join(self.directory, subdirectory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self, target=None):
+        # Least recently used files are removed until the cache fits in target,
+        # max_bytes by default
+        if target is None:
+            target = self.max_bytes
+
+        files = self.scan()
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+        self.size = total
+
+    def write_atomic(self, path, data):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_file.name, path)
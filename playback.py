@@ -0,0 +1,161 @@
+import sys
+import time
+import argparse
+
+import numpy
+
+import try3
+import metrics
+import key
+
+from smf import TrackWriter, encode_variable_int, NOTE_ON, NOTE_OFF, CONTROL_CHANGE, PROGRAM_CHANGE
+
+# Real-time playback of generated chords. chord_events turns a stream of chord
+# ids into timed midi messages, a Scheduler sends each message to a sink when it
+# is due. Chords are generated as they are played, so the first note sounds as
+# soon as the first chord is sampled.
+
+def chord_events(chords, vocabulary, instrument=0, transpose=0, velocity=100, channel=0):
+    # Yields (tick, message bytes) in time order, at try3.TICKS_PER_BEAT. Like
+    # in the written files, every note of a chord lasts the chord duration and
+    # the next chord starts when it ends.
+    yield 0, bytes((PROGRAM_CHANGE | channel, instrument))
+    yield 0, bytes((CONTROL_CHANGE | channel, 10, 64))
+
+    tick = 0
+    for chord in chords:
+        notes, duration = vocabulary[chord]
+        if transpose:
+            notes = key.transpose(notes, transpose).tolist()
+
+        for note in notes:
+            yield tick, bytes((NOTE_ON | channel, note, velocity))
+        tick += duration
+        for note in notes:
+            yield tick, bytes((NOTE_OFF | channel, note, 0))
+
+class StubSink:
+    # Keeps every message with the time it was sent, for tests
+    def __init__(self):
+        self.events = []
+
+    def send(self, tick, message):
+        self.events.append((time.perf_counter(), tick, message))
+
+    def close(self):
+        pass
+
+class PipeSink:
+    # Raw midi bytes to a binary stream (stdout, a fifo, a raw midi device)
+    def __init__(self, stream):
+        self.stream = stream
+
+    def send(self, tick, message):
+        self.stream.write(message)
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+class FileSink:
+    # Single track midi file, the messages are written as they arrive
+    def __init__(self, file_name, ticks_per_beat=try3.TICKS_PER_BEAT):
+        self.file = open(file_name, "wb")
+        self.writer = TrackWriter(self.file, ticks_per_beat)
+        self.tick = 0
+
+    def send(self, tick, message):
+        self.writer.write(encode_variable_int(tick - self.tick) + message)
+        self.tick = tick
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
+
+class PortSink:
+    # Output port of mido (needs a backend such as python-rtmidi)
+    def __init__(self, port_name=None):
+        import mido
+        self.mido = mido
+        self.port = mido.open_output(port_name)
+
+    def send(self, tick, message):
+        self.port.send(self.mido.Message.from_bytes(message))
+
+    def close(self):
+        self.port.close()
+
+class Scheduler:
+    # tempo in beats per minute. With realtime=False every message is sent
+    # right away, to write a file as fast as possible.
+    def __init__(self, sink, tempo=120, ticks_per_beat=try3.TICKS_PER_BEAT, realtime=True):
+        self.sink = sink
+        self.seconds_per_tick = 60 / (tempo * ticks_per_beat)
+        self.realtime = realtime
+        self.first_note_latency = None
+
+    def play(self, events):
+        # The clock starts before the first event is pulled, so with lazy events
+        # the latency of the first note includes sampling the first chord
+        start = time.perf_counter()
+        self.first_note_latency = None
+
+        for tick, message in events:
+            if self.realtime:
+                wait = start + tick * self.seconds_per_tick - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+
+            self.sink.send(tick, message)
+
+            if self.first_note_latency is None and message[0] & 0xf0 == NOTE_ON and message[2] != 0:
+                self.first_note_latency = time.perf_counter() - start
+                metrics.add_time("first_note", self.first_note_latency)
+
+            metrics.count("events_sent")
+
+        self.sink.close()
+
+def open_sink(name):
+    # "stub", "pipe" (stdout), "port" or "port:NAME", anything else is a midi file
+    if name == "stub":
+        return StubSink()
+    if name == "pipe":
+        return PipeSink(sys.stdout.buffer)
+    if name == "port" or name.startswith("port:"):
+        return PortSink(name[5:] or None)
+    return FileSink(name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="directory of a saved chain (try3.py --save)")
+    parser.add_argument("--sink", default="pipe", help="pipe (stdout), port, port:NAME, stub or a midi file name")
+    parser.add_argument("--notes", type=int, help="number of chords to play, forever when not given")
+    parser.add_argument("--tempo", type=float, default=120, help="tempo in beats per minute")
+    parser.add_argument("--seed", type=int, help="seed of the generation")
+    parser.add_argument("--key", help="key to transpose to from C major / A minor, e.g. D or Bm")
+    parser.add_argument("--instrument", type=int, default=0, help="midi program")
+    parser.add_argument("--no-realtime", action="store_true", help="send the messages without waiting for their time")
+    parser.add_argument("--verbose", action="store_true", help="print progress messages")
+    parser.add_argument("--metrics", help="save timings and counters to this json file")
+    args = parser.parse_args()
+
+    metrics.set_verbose(args.verbose)
+    metrics.enable(args.metrics is not None)
+
+    model = try3.load_chain(args.model)
+    transpose = key.shift_from_canonical(*key.parse_key(args.key)) if args.key else 0
+
+    chords = try3.generate_chords(model, args.notes, random_state=numpy.random.RandomState(args.seed))
+    scheduler = Scheduler(open_sink(args.sink), tempo=args.tempo, realtime=not args.no_realtime)
+
+    try:
+        scheduler.play(chord_events(chords, model.vocabulary, args.instrument, transpose))
+    except KeyboardInterrupt:
+        scheduler.sink.close()
+
+    if scheduler.first_note_latency is not None:
+        metrics.log("First note after : ", "{:.3f} ms".format(scheduler.first_note_latency * 1000))
+
+    if args.metrics:
+        metrics.save_report(args.metrics)
@@ -0,0 +1,55 @@
+import os
+import shlex
+import subprocess
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Renders midi files to scores (pdf, png, ...) in the background so that
+# generation does not wait for the renderer
+
+DEFAULT_COMMAND = "mscore {midi} -o {output}"
+
+RenderResult = collections.namedtuple("RenderResult", ["midi", "output", "returncode", "stderr", "timed_out"])
+
+class RenderQueue:
+    # command is a template where {midi} and {output} are replaced by the paths
+    # of each job, so any script taking the same arguments can stand in for MuseScore
+    def __init__(self, command=DEFAULT_COMMAND, workers=2, timeout=60):
+        self.command = shlex.split(command)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = []
+
+    def submit(self, midi_path, output_format="pdf"):
+        output_path = os.path.splitext(midi_path)[0] + "." + output_format
+        job = self.executor.submit(self.render, midi_path, output_path)
+        self.jobs.append(job)
+        return job
+
+    def render(self, midi_path, output_path):
+        command = [arg.format(midi=midi_path, output=output_path) for arg in self.command]
+
+        try:
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.timeout)
+        except subprocess.TimeoutExpired as err:
+            return RenderResult(midi_path, output_path, None, (err.stderr or b"").decode(errors="replace"), True)
+        except OSError as err:
+            return RenderResult(midi_path, output_path, None, str(err), False)
+
+        return RenderResult(midi_path, output_path, process.returncode, process.stderr.decode(errors="replace"), False)
+
+    def results(self):
+        # Waits for every submitted job, results are in submission order
+        return [job.result() for job in self.jobs]
+
+    def close(self):
+        results = self.results()
+        self.executor.shutdown()
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,248 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy
+
+import try3
+import metrics
+import key
+
+from structure import parse_structure, generate_sections, write_structured_midi
+
+# Local generation server. Saved chains (see try3.CompiledChain.save) are loaded
+# once and kept in memory, each request only samples and encodes a piece. It
+# speaks a minimal HTTP/1.0 over TCP or a Unix socket:
+#
+#   GET  /generate?model=default&length=100&seed=1&structure=ABACABA&key=D
+#        returns the midi file, length chords per section of the structure
+#        (see structure.py, a + in the query is written %2B)
+#   POST /reload?model=default[&path=DIR]
+#        loads the chain again (or another one) and swaps it in, requests
+#        already running finish with the previous chain
+#   GET  /models
+#   GET  /metrics
+#        timings and counters, with the latency percentiles of the last requests
+
+MAX_LENGTH = 100000
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+class GenerationServer:
+    def __init__(self, model_paths, workers=4, latency_window=1000):
+        # model_paths maps the name of every model to the directory it is loaded from
+        self.model_paths = dict(model_paths)
+        self.models = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.reload_lock = asyncio.Lock()
+
+    def load_all(self):
+        for name, path in self.model_paths.items():
+            self.models[name] = try3.load_chain(path)
+            metrics.log("Loaded model : ", name, path)
+
+    async def reload(self, name, path=None):
+        if name not in self.model_paths and path is None:
+            raise RequestError(404, "Unknown model : " + name)
+
+        path = path or self.model_paths[name]
+
+        # Loading runs in a worker thread, the chain in use is only replaced
+        # once the new one is complete
+        async with self.reload_lock:
+            loop = asyncio.get_running_loop()
+            try:
+                model = await loop.run_in_executor(self.executor, try3.load_chain, path)
+            except OSError as err:
+                raise RequestError(404, "Cannot load " + path + " : " + str(err))
+
+            self.models[name] = model
+            self.model_paths[name] = path
+
+        metrics.count("reloads")
+        metrics.log("Reloaded model : ", name, path)
+        return {"model": name, "path": path, "order": model.order, "contexts": len(model)}
+
+    def generate(self, model, length, seed, items, transpose, instrument):
+        # Runs in a worker thread
+        random_state = numpy.random.RandomState(seed)
+        sections = generate_sections(model, items, length, random_state)
+
+        midi_file = io.BytesIO()
+        write_structured_midi(midi_file, items, sections, model.vocabulary, instrument=instrument,
+                              ticks_per_beat=try3.TICKS_PER_BEAT, transpose=transpose)
+        return midi_file.getvalue()
+
+    async def handle_generate(self, query):
+        name = query.get("model", "default")
+        model = self.models.get(name)
+        if model is None:
+            raise RequestError(404, "Unknown model : " + name)
+
+        try:
+            length = int(query.get("length", 100))
+            seed = int(query["seed"]) if "seed" in query else None
+            instrument = int(query.get("instrument", 0))
+            transpose = key.shift_from_canonical(*key.parse_key(query["key"])) if "key" in query else 0
+            items = parse_structure(query.get("structure", "A"))
+        except (ValueError, KeyError, IndexError) as err:
+            raise RequestError(400, "Bad parameter : " + str(err))
+        if not model.order < length <= MAX_LENGTH:
+            raise RequestError(400, "length must be between " + str(model.order + 1) + " and " + str(MAX_LENGTH))
+        if len(items) * length > MAX_LENGTH:
+            raise RequestError(400, "pieces are limited to " + str(MAX_LENGTH) + " chords")
+        if not 0 <= instrument < 128:
+            raise RequestError(400, "instrument must be between 0 and 127")
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.generate, model, length, seed, items, transpose, instrument)
+
+    def metrics_report(self):
+        report = metrics.report()
+        if self.latencies:
+            latencies = numpy.array(self.latencies)
+            report["latency"] = {
+                "requests": len(latencies),
+                "mean": float(latencies.mean()),
+                "p50": float(numpy.percentile(latencies, 50)),
+                "p90": float(numpy.percentile(latencies, 90)),
+                "p99": float(numpy.percentile(latencies, 99)),
+                "max": float(latencies.max()),
+            }
+        return report
+
+    async def dispatch(self, method, path, query):
+        # (status, content type, body)
+        if path == "/generate":
+            if method != "GET":
+                raise RequestError(405, "Use GET")
+            return 200, "audio/midi", await self.handle_generate(query)
+
+        if path == "/reload":
+            if method != "POST":
+                raise RequestError(405, "Use POST")
+            result = await self.reload(query.get("model", "default"), query.get("path"))
+            return 200, "application/json", json.dumps(result).encode()
+
+        if path == "/models":
+            models = {name: {"path": self.model_paths[name], "order": model.order, "contexts": len(model)}
+                      for name, model in self.models.items()}
+            return 200, "application/json", json.dumps(models).encode()
+
+        if path == "/metrics":
+            return 200, "application/json", json.dumps(self.metrics_report()).encode()
+
+        raise RequestError(404, "Unknown path : " + path)
+
+    async def handle_connection(self, reader, writer):
+        start = time.perf_counter()
+        path = None
+
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+            # Headers are skipped, a body is read and ignored
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    content_length = int(value)
+            if content_length:
+                await reader.readexactly(content_length)
+
+            url = urlsplit(target)
+            path = url.path
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+            status, content_type, body = await self.dispatch(method, path, query)
+        except RequestError as err:
+            status, content_type, body = err.status, "text/plain", (str(err) + "\n").encode()
+        except (ValueError, asyncio.IncompleteReadError):
+            status, content_type, body = 400, "text/plain", b"Malformed request\n"
+        except Exception as err:
+            status, content_type, body = 500, "text/plain", (repr(err) + "\n").encode()
+
+        seconds = time.perf_counter() - start
+        header = "HTTP/1.0 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nX-Generation-Seconds: {:.6f}\r\nConnection: close\r\n\r\n"
+        writer.write(header.format(status, REASONS[status], content_type, len(body), seconds).encode("latin-1") + body)
+
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+        if path == "/generate":
+            self.latencies.append(seconds)
+        metrics.count("requests")
+        if status != 200:
+            metrics.count("failed_requests")
+        metrics.log("Request : ", path, status, "{:.1f} ms".format(seconds * 1000))
+
+    async def serve(self, host="127.0.0.1", port=8000, socket_path=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+
+        metrics.log("Serving on : ", socket_path or host + ":" + str(port))
+
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+def parse_model_arguments(models):
+    # "name=DIR" or "DIR", a plain directory is the default model
+    model_paths = {}
+    for model in models:
+        name, separator, path = model.partition("=")
+        if separator:
+            model_paths[name] = path
+        else:
+            model_paths["default"] = model
+    return model_paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", nargs="+", help="directories of saved chains (try3.py --save), as DIR or NAME=DIR")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--socket", help="path of a Unix socket to listen on instead of a port")
+    parser.add_argument("--workers", type=int, default=4, help="number of pieces generated at the same time")
+    parser.add_argument("--verbose", action="store_true", help="print a line per request")
+    args = parser.parse_args()
+
+    metrics.set_verbose(args.verbose)
+    metrics.enable()
+
+    async def run_server():
+        server = GenerationServer(parse_model_arguments(args.models), workers=args.workers)
+        server.load_all()
+        try:
+            await server.serve(args.host, args.port, args.socket)
+        finally:
+            server.close()
+
+    try:
+        asyncio.run(run_server())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,324 @@
+import mmap
+import struct
+
+import numpy
+
+import metrics
+import key
+
+# Minimal Standard MIDI File encoding, writes the same bytes as mido does for
+# the tracks built by try3.write_midi without creating Message objects. The
+# decoder goes the other way for note events only.
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+
+END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+# Every onset and duration is kept as an integer number of ticks at this
+# resolution, which is also the resolution of the generated midi files
+TICKS_PER_BEAT = 10
+
+def encode_variable_int(value):
+    # Variable length quantity: 7 bits per byte, most significant first, high bit
+    # set on every byte but the last
+    if value < 0:
+        raise ValueError("delta time must be non-negative in a MIDI file")
+
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        data.insert(0, (value & 0x7f) | 0x80)
+        value >>= 7
+    return bytes(data)
+
+def encode_chord(notes, duration, velocity=100, channel=0):
+    # All the notes start together and the first note_off carries the duration.
+    # The note_on and note_off runs use running status. A chord always starts
+    # with a full status byte since whatever comes before is not a note_on, so
+    # the bytes of a chord do not depend on what precedes it.
+    data = bytearray()
+
+    for i, note in enumerate(notes):
+        data += b"\x00"
+        if i == 0:
+            data.append(NOTE_ON | channel)
+        data += bytes((note, velocity))
+
+    for i, note in enumerate(notes):
+        if i == 0:
+            data += encode_variable_int(duration)
+            data.append(NOTE_OFF | channel)
+        else:
+            data += b"\x00"
+        data += bytes((note, 0))
+
+    return bytes(data)
+
+def encode_transposed_chord(notes, duration, transpose=0):
+    if transpose:
+        notes = key.transpose(notes, transpose).tolist()
+    return encode_chord(notes, duration)
+
+def encode_chords(chords, vocabulary, transpose=0, encoded_chords=None):
+    # Track bytes of a list of chord ids. Since the bytes of a chord do not
+    # depend on what precedes it, encoded runs of chords can be joined as is.
+    # encoded_chords caches the bytes of every id across calls.
+    if encoded_chords is None:
+        encoded_chords = {}
+
+    data = bytearray()
+    for chord in chords:
+        chord_data = encoded_chords.get(chord)
+        if chord_data is None:
+            chord_data = encode_transposed_chord(*vocabulary[chord], transpose)
+            encoded_chords[chord] = chord_data
+        data += chord_data
+    return bytes(data)
+
+def chord_notes(chord):
+    # (notes, duration) of a try3.Chord
+    return [note.note for note in chord.notes], chord.notes[0].duration
+
+class TrackWriter:
+    # Writes a single track MIDI file to a seekable binary file in chunks. The
+    # length of the track is unknown until close, the header is patched then.
+    def __init__(self, file, ticks_per_beat=10, chunk_size=1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.length = 0
+
+        self.file.write(b"MThd" + struct.pack(">L", 6) + struct.pack(">hhh", 1, 1, ticks_per_beat))
+        self.length_position = self.file.tell() + 4
+        self.file.write(b"MTrk" + struct.pack(">L", 0))
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.length += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.write(END_OF_TRACK)
+        self.flush()
+
+        end = self.file.tell()
+        self.file.seek(self.length_position)
+        self.file.write(struct.pack(">L", self.length))
+        self.file.seek(end)
+
+        return self.length
+
+def write_midi_stream(file, chords, instrument=0, vocabulary=None, ticks_per_beat=10, chunk_size=1 << 16, transpose=0):
+    # Streaming version of try3.write_midi. file is a path or a seekable binary
+    # file, chords any iterable of try3.Chord, or of chord ids when a vocabulary
+    # is given (the bytes of every id are only encoded once). Every note is
+    # moved by transpose semitones. Returns the number of bytes in the track.
+    if isinstance(file, str):
+        with open(file, "wb") as midi_file:
+            return write_midi_stream(midi_file, chords, instrument, vocabulary, ticks_per_beat, chunk_size, transpose)
+
+    with metrics.span("write"):
+        writer = TrackWriter(file, ticks_per_beat, chunk_size)
+
+        writer.write(bytes((0, PROGRAM_CHANGE, instrument, 0, CONTROL_CHANGE, 10, 64)))
+
+        encoded_chords = {}
+        for chord in chords:
+            if vocabulary is None:
+                writer.write(encode_transposed_chord(*chord_notes(chord), transpose))
+                continue
+
+            data = encoded_chords.get(chord)
+            if data is None:
+                data = encode_transposed_chord(*vocabulary[chord], transpose)
+                encoded_chords[chord] = data
+            writer.write(data)
+
+        length = writer.close()
+
+    # 14 bytes of MThd chunk and 8 of MTrk header
+    metrics.count("bytes_written", length + 22)
+
+    return length
+
+# Note events of a track, in file order. type is NOTE_ON or NOTE_OFF (a note_on
+# of velocity 0 keeps the NOTE_ON type) and delta is the delta time of the
+# event, counted from the previous event of any kind.
+EVENT_DTYPE = [("tick", numpy.int64), ("delta", numpy.int64), ("type", numpy.uint8), ("channel", numpy.uint8),
+               ("pitch", numpy.uint8), ("velocity", numpy.uint8)]
+
+def decode_variable_int(data, position):
+    byte = data[position]
+    position += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7f)
+    return value, position
+
+def key_from_signature(sharps, minor):
+    # (tonic, minor) of a key_signature meta event, sharps is -7 to 7
+    if minor:
+        return (sharps * 7 + 9) % 12, True
+    return sharps * 7 % 12, False
+
+def decode_track(data, position, end):
+    # (EVENT_DTYPE array, key signature or None) of the track in data[position:end]
+    events = []
+    append = events.append
+    key_signature = None
+
+    tick = 0
+    status = None
+
+    while position < end:
+        # Most delta times fit in one byte
+        byte = data[position]
+        position += 1
+        delta = byte & 0x7f
+        while byte & 0x80:
+            byte = data[position]
+            position += 1
+            delta = (delta << 7) | (byte & 0x7f)
+        tick += delta
+
+        byte = data[position]
+        if byte & 0x80:
+            position += 1
+
+            if byte == 0xff:
+                # Meta events do not change the running status
+                meta_type = data[position]
+                length, position = decode_variable_int(data, position + 1)
+                if meta_type == 0x59 and length == 2 and key_signature is None:
+                    sharps, minor = data[position], data[position + 1]
+                    if sharps > 127:
+                        sharps -= 256
+                    if -7 <= sharps <= 7 and minor in (0, 1):
+                        key_signature = key_from_signature(sharps, minor)
+                position += length
+                continue
+
+            status = byte
+
+            if byte == 0xf0 or byte == 0xf7:
+                length, position = decode_variable_int(data, position)
+                position += length
+                continue
+        elif status is None:
+            raise ValueError("running status without a previous status")
+
+        # Notes are recorded with the position of their data bytes, read at the end
+        if status < 0xa0:
+            append((tick, delta, status, position))
+            position += 2
+        elif status < 0xc0:
+            position += 2
+        elif status < 0xe0:
+            position += 1
+        elif status < 0xf0:
+            position += 2
+        else:
+            raise ValueError("unsupported status byte 0x{:02x}".format(status))
+
+    if position != end:
+        raise ValueError("event crosses the end of the track")
+
+    raw_events = numpy.array(events, dtype=numpy.int64).reshape(-1, 4)
+    data_bytes = numpy.frombuffer(data, dtype=numpy.uint8)
+    pitches = data_bytes[raw_events[:, 3]]
+    velocities = data_bytes[raw_events[:, 3] + 1]
+
+    # The mapped file cannot be closed while an array still points into it
+    del data_bytes
+
+    if (pitches > 127).any() or (velocities > 127).any():
+        raise ValueError("data byte must be in range 0..127")
+
+    track_events = numpy.zeros(len(raw_events), dtype=EVENT_DTYPE)
+    track_events["tick"] = raw_events[:, 0]
+    track_events["delta"] = raw_events[:, 1]
+    track_events["type"] = raw_events[:, 2] & 0xf0
+    track_events["channel"] = raw_events[:, 2] & 0x0f
+    track_events["pitch"] = pitches
+    track_events["velocity"] = velocities
+
+    return track_events, key_signature
+
+def decode_note_events(data):
+    # (ticks per beat, note events of every track, first key signature or None)
+    # of a midi file held in a bytes-like object
+    if bytes(data[:4]) != b"MThd":
+        raise ValueError("MThd not found")
+
+    header_length, midi_type, nb_tracks, ticks_per_beat = struct.unpack(">LhhH", data[4:14])
+    if header_length < 6:
+        raise ValueError("MThd chunk too short")
+    if ticks_per_beat & 0x8000:
+        raise ValueError("SMPTE time division")
+
+    position = 8 + header_length
+    tracks = []
+    key_signature = None
+
+    for i in range(nb_tracks):
+        name, length = struct.unpack(">4sL", data[position:position + 8])
+        if name != b"MTrk":
+            raise ValueError("no MTrk header at start of track")
+        position += 8
+        if position + length > len(data):
+            raise ValueError("track crosses the end of the file")
+
+        events, track_key_signature = decode_track(data, position, position + length)
+        tracks.append(events)
+        if key_signature is None:
+            key_signature = track_key_signature
+
+        position += length
+
+    return ticks_per_beat, tracks, key_signature
+
+def track_note_events(track):
+    # EVENT_DTYPE array of a mido track
+    events = []
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        if msg.type == "note_on" or msg.type == "note_off":
+            events.append((tick, msg.time, NOTE_ON if msg.type == "note_on" else NOTE_OFF, msg.channel, msg.note, msg.velocity))
+    return numpy.array(events, dtype=EVENT_DTYPE)
+
+def read_note_events(file_name):
+    # decode_note_events on a memory-mapped file. Files it cannot decode are
+    # read again with mido, which accepts more of the malformed files out there
+    # (or raises a clearer error).
+    try:
+        with open(file_name, "rb") as midi_file, mmap.mmap(midi_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                return decode_note_events(view)
+            finally:
+                view.release()
+    except (ValueError, IndexError, struct.error) as err:
+        metrics.log("Decoding with mido : ", file_name, err)
+        metrics.count("mido_fallbacks")
+
+    from mido import MidiFile
+
+    midi = MidiFile(file_name)
+    key_signature = None
+    for track in midi.tracks:
+        for msg in track:
+            if msg.type == "key_signature" and key_signature is None:
+                key_signature = key.parse_key(msg.key)
+
+    return midi.ticks_per_beat, [track_note_events(track) for track in midi.tracks], key_signature
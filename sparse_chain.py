@@ -0,0 +1,46 @@
+import numpy
+
+from scipy import sparse
+
+# Transition counting on scipy.sparse CSR matrices (contexts x next states),
+# used by try3.SparseChain and by the --sparse mode of main.py
+
+def count_transitions(contexts, next_states, nb_states, weights=None):
+    # contexts is a (transitions, order) array. Returns the distinct contexts,
+    # sorted, and the CSR matrix of counts with one row per distinct context
+    if weights is None:
+        weights = numpy.ones(len(next_states), dtype=numpy.int64)
+
+    unique_contexts, rows = numpy.unique(contexts, axis=0, return_inverse=True)
+
+    counts = sparse.coo_matrix((weights, (rows.ravel(), next_states)), shape=(len(unique_contexts), nb_states)).tocsr()
+    counts.sum_duplicates()
+
+    return unique_contexts, counts
+
+def transition_matrix(sequences, nb_states):
+    # Order 1 counts of a list of state sequences in a nb_states x nb_states matrix
+    sequences = [numpy.asarray(sequence, dtype=numpy.int64) for sequence in sequences if len(sequence) > 1]
+
+    if not sequences:
+        return sparse.csr_matrix((nb_states, nb_states), dtype=numpy.int64)
+
+    previous_states = numpy.concatenate([sequence[:-1] for sequence in sequences])
+    next_states = numpy.concatenate([sequence[1:] for sequence in sequences])
+    weights = numpy.ones(len(next_states), dtype=numpy.int64)
+
+    counts = sparse.coo_matrix((weights, (previous_states, next_states)), shape=(nb_states, nb_states)).tocsr()
+    counts.sum_duplicates()
+
+    return counts
+
+def normalize_rows(matrix):
+    # Divide every row by its sum in one step, empty rows stay at 0
+    totals = numpy.asarray(matrix.sum(axis=1), dtype=numpy.float64).ravel()
+    inverse = numpy.divide(1.0, totals, out=numpy.zeros_like(totals), where=totals > 0)
+    return sparse.csr_matrix(sparse.diags(inverse) @ matrix)
+
+def expand_rows(contexts, counts):
+    # Back to (contexts, next states, counts) triplets, one per stored transition
+    rows = numpy.repeat(numpy.arange(counts.shape[0]), numpy.diff(counts.indptr))
+    return contexts[rows], counts.indices, counts.data
@@ -0,0 +1,127 @@
+import numpy
+
+import metrics
+
+from smf import TrackWriter, encode_chords, PROGRAM_CHANGE, CONTROL_CHANGE, TICKS_PER_BEAT
+from generate import create_midi_batch, generate_chords
+
+# Piece structures such as "ABACABA". Every distinct section is generated and
+# encoded once, a repeat only splices the bytes of the section into the track.
+#
+#   A B C      sections, any letter
+#   A' A''     variations: the first half of the section they vary, then a
+#              new continuation (A'' varies A')
+#   (AB)       group
+#   X*3        X three times, for a section or a group
+#   X+2 X-5    X transposed by a number of semitones
+#
+# For example "A(BA')*2C+5A" or "((AB)*2C)*2".
+
+def parse_number(text, position, signs):
+    # Integer at position, optionally led by one of signs. Returns (number or
+    # None when there is none, position after it)
+    end = position
+    if end < len(text) and text[end] in signs:
+        end += 1
+    while end < len(text) and text[end].isdigit():
+        end += 1
+
+    if end == position:
+        return None, position
+    if not text[position + (text[position] in signs):end]:
+        raise ValueError("Number expected at " + str(end) + " in " + text)
+    return int(text[position:end]), end
+
+def parse_sequence(text, position):
+    items = []
+
+    while position < len(text) and text[position] != ")":
+        if text[position].isspace():
+            position += 1
+            continue
+
+        if text[position] == "(":
+            group, position = parse_sequence(text, position + 1)
+            if position >= len(text):
+                raise ValueError("Unclosed group in " + text)
+            position += 1
+        elif text[position].isalpha():
+            name = text[position]
+            position += 1
+            while position < len(text) and text[position] == "'":
+                name += "'"
+                position += 1
+            group = [(name, 0)]
+        else:
+            raise ValueError("Unexpected " + repr(text[position]) + " at " + str(position) + " in " + text)
+
+        transpose, position = parse_number(text, position, "+-")
+        if transpose is not None:
+            group = [(name, shift + transpose) for name, shift in group]
+
+        if position < len(text) and text[position] == "*":
+            repeats, position = parse_number(text, position + 1, "")
+            if repeats is None:
+                raise ValueError("Number of repeats expected at " + str(position) + " in " + text)
+            group = group * repeats
+
+        items += group
+
+    return items, position
+
+def parse_structure(text):
+    # List of (section name, transpose) in playing order
+    items, position = parse_sequence(text, 0)
+    if position != len(text):
+        raise ValueError("Unmatched ) at " + str(position) + " in " + text)
+    if not items:
+        raise ValueError("Empty structure")
+    return items
+
+def generate_sections(markov_chain, items, nb_notes=100, random_state=numpy.random, backoff_depths=None):
+    # Chord ids of every distinct section of items. The plain sections are drawn
+    # in a single batch, then every variation continues the first half of the
+    # section it varies.
+    names = set(name for name, transpose in items)
+    for name in list(names):
+        names.update(name[:i] for i in range(1, len(name)))
+
+    base_names = sorted(name for name in names if not name.endswith("'"))
+    sections = dict(zip(base_names, create_midi_batch(markov_chain, len(base_names), nb_notes, backoff_depths, random_state)))
+
+    keep = min(max(nb_notes // 2, markov_chain.order), nb_notes)
+    for name in sorted(names - set(base_names), key=len):
+        start = sections[name[:-1]][:keep]
+        sections[name] = list(generate_chords(markov_chain, nb_notes, backoff_depths, random_state, start=start))
+
+    return sections
+
+def write_structured_midi(file, items, sections, vocabulary, instrument=0, ticks_per_beat=TICKS_PER_BEAT, transpose=0):
+    # Same file as write_midi_stream on the concatenated sections. file is a
+    # path or a seekable binary file. Returns the number of bytes in the track.
+    if isinstance(file, str):
+        with open(file, "wb") as midi_file:
+            return write_structured_midi(midi_file, items, sections, vocabulary, instrument, ticks_per_beat, transpose)
+
+    with metrics.span("write"):
+        writer = TrackWriter(file, ticks_per_beat)
+        writer.write(bytes((0, PROGRAM_CHANGE, instrument, 0, CONTROL_CHANGE, 10, 64)))
+
+        # Bytes of every chord per transposition, and of every (section, transposition)
+        encoded_chords = {}
+        encoded_sections = {}
+        for name, shift in items:
+            data = encoded_sections.get((name, shift))
+            if data is None:
+                data = encode_chords(sections[name], vocabulary, transpose + shift, encoded_chords.setdefault(transpose + shift, {}))
+                encoded_sections[(name, shift)] = data
+                metrics.count("sections_encoded")
+            else:
+                metrics.count("sections_spliced")
+            writer.write(data)
+
+        length = writer.close()
+
+    metrics.count("bytes_written", length + 22)
+
+    return length
@@ -0,0 +1,78 @@
+import os
+import random
+import argparse
+
+from mido import MidiFile, MidiTrack, Message, MetaMessage, bpm2tempo
+
+# Deterministic synthetic midi files for the benchmarks: the same parameters and
+# seed always give the same bytes
+
+DURATIONS = [0.25, 0.5, 1, 1.5, 2]
+
+def synth_midi(file_name, nb_notes=1000, polyphony=3, nb_tracks=1, tempo=120, ticks_per_beat=480, seed=0):
+    rng = random.Random(seed)
+
+    midi = MidiFile(ticks_per_beat=ticks_per_beat)
+
+    for track_index in range(nb_tracks):
+        track = MidiTrack()
+        midi.tracks.append(track)
+
+        track.append(MetaMessage("track_name", name="synth " + str(track_index), time=0))
+        if track_index == 0:
+            track.append(MetaMessage("set_tempo", tempo=bpm2tempo(tempo), time=0))
+
+        # Absolute (tick, is note_on, pitch) events, chords of 1 to polyphony notes
+        events = []
+        tick = 0
+        base_note = 48 + 12 * (track_index % 3)
+        notes_left = nb_notes
+
+        while notes_left > 0:
+            chord_size = min(rng.randint(1, polyphony), notes_left)
+            duration = int(rng.choice(DURATIONS) * ticks_per_beat)
+
+            for pitch in rng.sample(range(base_note, base_note + 24), chord_size):
+                events.append((tick, 1, pitch))
+                events.append((tick + duration, 0, pitch))
+
+            tick += duration if rng.random() < 0.8 else duration // 2
+            notes_left -= chord_size
+
+        # note_off before note_on on the same tick so a repeated pitch is released first
+        events.sort(key=lambda event: (event[0], event[1]))
+
+        previous_tick = 0
+        for tick, is_note_on, pitch in events:
+            if is_note_on:
+                track.append(Message("note_on", note=pitch, velocity=rng.randint(40, 110), time=tick - previous_tick))
+            else:
+                track.append(Message("note_off", note=pitch, velocity=0, time=tick - previous_tick))
+            previous_tick = tick
+
+    midi.save(file_name)
+    return file_name
+
+def synth_corpus(directory, nb_files, seed=0, **params):
+    os.makedirs(directory, exist_ok=True)
+
+    file_names = []
+    for i in range(nb_files):
+        file_name = os.path.join(directory, "synth_" + str(i) + ".mid")
+        file_names.append(synth_midi(file_name, seed=seed * 1000003 + i, **params))
+
+    return file_names
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="where to write the midi files")
+    parser.add_argument("--files", type=int, default=10, help="number of midi files")
+    parser.add_argument("--notes", type=int, default=1000, help="number of notes per track")
+    parser.add_argument("--polyphony", type=int, default=3, help="maximum number of notes per chord")
+    parser.add_argument("--tracks", type=int, default=1, help="number of tracks per file")
+    parser.add_argument("--tempo", type=int, default=120, help="tempo in beats per minute")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    synth_corpus(args.directory, args.files, seed=args.seed, nb_notes=args.notes, polyphony=args.polyphony,
+                 nb_tracks=args.tracks, tempo=args.tempo)
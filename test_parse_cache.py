@@ -0,0 +1,44 @@
+import os
+import glob
+
+import numpy
+import pytest
+
+import try3
+
+from parse_cache import ParseCache
+from synth_midi import synth_midi
+
+def corrupt_truncate(path):
+    with open(path, "rb") as entry_file:
+        data = entry_file.read()
+    with open(path, "wb") as entry_file:
+        entry_file.write(data[:len(data) // 2])
+
+def corrupt_garbage(path):
+    with open(path, "wb") as entry_file:
+        entry_file.write(b"not a zip file")
+
+def corrupt_missing_array(path):
+    arrays = dict(numpy.load(path))
+    del arrays["offsets"]
+    with open(path, "wb") as entry_file:
+        numpy.savez(entry_file, **arrays)
+
+@pytest.mark.parametrize("corrupt", [corrupt_truncate, corrupt_garbage, corrupt_missing_array])
+def test_bad_entry_is_a_miss(tmp_path, corrupt):
+    file_name = synth_midi(str(tmp_path / "synth.mid"), nb_notes=100)
+    cache = ParseCache(str(tmp_path / "cache"))
+
+    expected = try3.read_midi(file_name, cache=cache).keys()
+    entries = glob.glob(str(tmp_path / "cache" / "entries" / "*.npz"))
+    assert len(entries) == 1
+
+    corrupt(entries[0])
+    assert cache.get(file_name, (0, False, try3.TICKS_PER_BEAT), ("notes", "offsets")) is None
+    assert not os.path.exists(entries[0])
+
+    # Parsed again and written back
+    assert try3.read_midi(file_name, cache=cache).keys() == expected
+    assert os.path.exists(entries[0])
+    assert try3.read_midi(file_name, cache=cache).keys() == expected
@@ -0,0 +1,201 @@
+import numpy
+import pytest
+
+from mido import MidiFile, MidiTrack, Message
+
+import try3
+import smf
+
+from synth_midi import synth_midi
+
+# Regression of the single pass note pairing of try3.read_midi against the
+# rescan pairing it replaced
+
+def rescan_pair_notes(track, ticks_per_beat):
+    # The previous pairing: every note_on scans the rest of the track for the
+    # first note_off of its pitch. Times are kept in ticks and rescaled like
+    # try3 does, so only the pairing is compared. Returns (note, restrike)
+    # pairs, restrike when the pitch was still sounding: those notes ended on
+    # the note_off of the earlier note, now they are closed in order.
+    notes = []
+    notes_only_track = [msg for msg in track if msg.type in ("note_on", "note_off")]
+    sounding = {}
+
+    current_time = 0
+    for i, msg in enumerate(notes_only_track):
+        current_time += msg.time
+
+        if msg.type == "note_off" or msg.velocity == 0:
+            sounding[msg.note] = max(sounding.get(msg.note, 0) - 1, 0)
+            continue
+
+        restrike = sounding.get(msg.note, 0) > 0
+        sounding[msg.note] = sounding.get(msg.note, 0) + 1
+
+        stop_time = current_time
+        for msg2 in notes_only_track[i + 1:]:
+            stop_time += msg2.time
+
+            if msg2.note == msg.note and (msg2.type == "note_off" or msg2.velocity == 0):
+                onset = try3.rescale_ticks(current_time, ticks_per_beat)
+                notes.append((try3.Note(msg.note, try3.rescale_ticks(stop_time, ticks_per_beat) - onset, onset), restrike))
+                break
+
+    return notes
+
+def rescan_notes_to_chords(notes):
+    # The previous grouping: consecutive notes with the same time, in list
+    # order. Returns (chord, whether it holds a restrike) pairs.
+    chords = []
+
+    i = 0
+    while i < len(notes):
+        j = i + 1
+        while j < len(notes) and notes[j][0].time == notes[i][0].time:
+            j += 1
+        chords.append((try3.Chord([note for note, restrike in notes[i:j]]), any(restrike for note, restrike in notes[i:j])))
+        i = j
+
+    return chords
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("ticks_per_beat", [96, 480])
+@pytest.mark.parametrize("polyphony", [1, 4])
+def test_single_track_matches_rescan(tmp_path, seed, ticks_per_beat, polyphony):
+    file_name = synth_midi(str(tmp_path / "synth.mid"), nb_notes=300, polyphony=polyphony, ticks_per_beat=ticks_per_beat, seed=seed)
+
+    midi = MidiFile(file_name)
+    expected = rescan_notes_to_chords(rescan_pair_notes(midi.tracks[0], midi.ticks_per_beat))
+
+    chords = try3.read_midi(file_name)
+    assert len(chords) == len(expected)
+
+    # Chords with a restrike keep their notes and onset, only the duration moved
+    for chord, (expected_chord, restrike) in zip(chords, expected):
+        assert chord.notes[0].time == expected_chord.notes[0].time
+        if restrike:
+            assert chord.to_key()[0] == expected_chord.to_key()[0]
+        else:
+            assert chord.to_key() == expected_chord.to_key()
+
+def pair_track(messages, ticks_per_beat=try3.TICKS_PER_BEAT):
+    # (pitch, onset, duration) of the notes of a track of mido messages
+    notes = try3.pair_notes(smf.track_note_events(MidiTrack(messages)), ticks_per_beat)
+    return list(zip(notes["pitch"].tolist(), notes["onset"].tolist(), notes["duration"].tolist()))
+
+def test_restrikes_close_first_in_first_out():
+    notes = pair_track([
+        Message("note_on", note=60, velocity=100, time=0),
+        Message("note_on", note=60, velocity=100, time=10),
+        Message("note_off", note=60, velocity=0, time=10),
+        Message("note_on", note=60, velocity=0, time=10),
+    ])
+
+    assert notes == [(60, 0, 20), (60, 10, 20)]
+
+def test_channels_are_paired_apart():
+    notes = pair_track([
+        Message("note_on", channel=0, note=60, velocity=100, time=0),
+        Message("note_on", channel=1, note=60, velocity=100, time=5),
+        Message("note_off", channel=1, note=60, velocity=0, time=5),
+        Message("note_off", channel=0, note=60, velocity=0, time=10),
+    ])
+
+    assert notes == [(60, 0, 20), (60, 5, 5)]
+
+def test_unclosed_notes_are_dropped():
+    notes = pair_track([
+        Message("note_on", note=60, velocity=100, time=0),
+        Message("note_on", note=64, velocity=100, time=0),
+        Message("note_off", note=64, velocity=0, time=10),
+    ])
+
+    assert notes == [(64, 0, 10)]
+
+@pytest.mark.parametrize("order", [1, 2, 3])
+def test_backends_compile_to_the_same_chain(tmp_path, order):
+    file_names = [synth_midi(str(tmp_path / ("synth" + str(seed) + ".mid")), nb_notes=200, seed=seed) for seed in range(3)]
+
+    dict_model = try3.train_chain(file_names, order).compile()
+    sparse_model = try3.train_chain(file_names, order, chain_class=try3.SparseChain).compile()
+
+    for name in try3.CHAIN_ARRAYS:
+        assert numpy.array_equal(getattr(dict_model, name), getattr(sparse_model, name)), name
+    for dict_array, sparse_array in zip(dict_model.durations, sparse_model.durations):
+        assert numpy.array_equal(dict_array, sparse_array)
+
+    assert try3.create_midi_data(dict_model, 100, random_state=numpy.random.RandomState(0)) == \
+        try3.create_midi_data(sparse_model, 100, random_state=numpy.random.RandomState(0))
+
+def chord_onsets(onsets, window):
+    notes = numpy.zeros(len(onsets), dtype=try3.NOTE_DTYPE)
+    notes["onset"] = onsets
+    notes["pitch"] = 60 + numpy.arange(len(onsets))
+    chords = try3.notes_to_chords(notes, window)
+    return [chord.notes[0].time for chord in chords], numpy.diff(chords.offsets).tolist()
+
+def test_chord_window_does_not_chain():
+    # Every onset is within the window of the previous one, not of the first
+    assert chord_onsets([0, 2, 4, 6, 8, 10], 2) == ([0, 4, 8], [2, 2, 2])
+    assert chord_onsets([0, 2, 4, 6, 8, 10], 0) == ([0, 2, 4, 6, 8, 10], [1] * 6)
+    assert chord_onsets([0, 0, 1, 5, 5, 9], 1) == ([0, 5, 9], [3, 2, 1])
+
+@pytest.mark.parametrize("chain_class", [try3.MarkovChain, try3.SparseChain])
+def test_backoff_chains_count_like_lower_orders(tmp_path, chain_class):
+    file_names = [synth_midi(str(tmp_path / ("synth" + str(seed) + ".mid")), nb_notes=100, seed=seed) for seed in range(3)]
+
+    model = try3.train_chain(file_names, 3, chain_class=chain_class).compile()
+    for depth, chain in enumerate(model.backoff, 1):
+        expected = try3.train_chain(file_names, 3 - depth, chain_class=chain_class).compile()
+        for name in ["contexts", "indptr", "successors", "weights"]:
+            assert numpy.array_equal(getattr(chain, name), getattr(expected, name)), name
+
+    # The heads survive a save and load, so more files can be added
+    model.save(str(tmp_path / "model"))
+    chain = try3.MarkovChain.from_compiled(try3.load_chain(str(tmp_path / "model")))
+    assert chain.heads == try3.train_chain(file_names, 3).heads
+
+def test_loaded_vocabulary_is_decoded_lazily(tmp_path):
+    file_names = [synth_midi(str(tmp_path / ("synth" + str(seed) + ".mid")), nb_notes=100, seed=seed) for seed in range(2)]
+    chain = try3.train_chain(file_names, 2)
+    chain.save(str(tmp_path / "model"))
+
+    vocabulary = try3.load_chain(str(tmp_path / "model")).vocabulary
+    assert isinstance(vocabulary.chord_notes, numpy.memmap)
+    assert [vocabulary[chord_id] for chord_id in range(len(vocabulary))] == list(chain.vocabulary)
+    assert vocabulary.id_dict is None
+
+    # New chords go after the stored ones and are saved with them
+    assert vocabulary.intern(chain.vocabulary[3]) == 3
+    assert vocabulary.intern(((1, 2), 7)) == len(chain.vocabulary)
+    assert try3.Vocabulary.from_arrays(*vocabulary.to_arrays())[len(chain.vocabulary)] == ((1, 2), 7)
+
+@pytest.mark.parametrize("order", [1, 2, 3])
+def test_merged_matches_training_on_every_file(tmp_path, order):
+    file_names = [synth_midi(str(tmp_path / ("synth" + str(seed) + ".mid")), nb_notes=150, seed=seed) for seed in range(4)]
+
+    model = try3.train_chain(file_names[:2], order).compile()
+    model.save(str(tmp_path / "model"))
+    merged = try3.load_chain(str(tmp_path / "model")).merged(try3.train_chain(file_names[2:], order))
+    expected = try3.train_chain(file_names, order).compile()
+
+    assert len(merged.backoff) == len(expected.backoff) == order
+    for chain, expected_chain in zip([merged] + merged.backoff, [expected] + expected.backoff):
+        for name in try3.CHAIN_ARRAYS:
+            assert numpy.array_equal(getattr(chain, name), getattr(expected_chain, name)), name
+    for array, expected_array in zip(merged.durations, expected.durations):
+        assert numpy.array_equal(array, expected_array)
+
+def test_alias_tables_sample_the_row_probabilities():
+    random_state = numpy.random.RandomState(0)
+    sizes = numpy.array([1, 2, 3, 7, 50, 400])
+    indptr = numpy.concatenate([[0], numpy.cumsum(sizes)])
+    weights = random_state.zipf(1.5, indptr[-1])
+    weights[indptr[2]:indptr[3]] = 5
+
+    accept, alias = try3.build_alias_tables(indptr, weights)
+
+    rows = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    assert (rows[alias] == rows).all()
+    probs = (accept + numpy.bincount(alias, weights=1 - accept, minlength=len(weights))) / sizes[rows]
+    assert numpy.allclose(probs, weights / numpy.bincount(rows, weights=weights)[rows], rtol=0, atol=1e-12)
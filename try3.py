@@ -1,63 +1,925 @@
 import numpy
 import glob
+import argparse
+import os
+import sys
+import tempfile
+
+from multiprocessing import Pool
 
 from mido import MidiFile, MidiTrack, Message
 
+from smf import read_note_events, NOTE_ON, TICKS_PER_BEAT
+from generate import create_midi_data, generate_chords, create_midi_batch
+from render import RenderQueue, DEFAULT_COMMAND
+from parse_cache import ParseCache
+from structure import parse_structure, generate_sections, write_structured_midi
+
+import metrics
+import key
+
+class Vocabulary:
+    # Every distinct (notes, duration) chord gets an integer id the first time it
+    # is seen. The chords are kept in the arrays of to_arrays, memory-mapped for
+    # a loaded chain, followed by a list of the chords interned since. A chord
+    # is only decoded when asked for, and the dict from chords to ids is only
+    # built when a chord is interned or looked up.
+    def __init__(self, chord_indptr=None, chord_notes=None, chord_durations=None):
+        if chord_indptr is None:
+            chord_indptr = numpy.zeros(1, dtype=numpy.int64)
+            chord_notes = numpy.zeros(0, dtype=numpy.int32)
+            chord_durations = numpy.zeros(0, dtype=numpy.int32)
+
+        self.chord_indptr = chord_indptr
+        self.chord_notes = chord_notes
+        self.chord_durations = chord_durations
+        self.new_chords = []
+        self.id_dict = None
+
+    def __len__(self):
+        return len(self.chord_durations) + len(self.new_chords)
+
+    def __getitem__(self, chord_id):
+        # (notes, duration) of a chord id
+        nb_stored = len(self.chord_durations)
+        if chord_id >= nb_stored:
+            return self.new_chords[chord_id - nb_stored]
+        start, end = self.chord_indptr[chord_id], self.chord_indptr[chord_id + 1]
+        return tuple(self.chord_notes[start:end].tolist()), int(self.chord_durations[chord_id])
+
+    def __iter__(self):
+        chord_indptr = self.chord_indptr.tolist()
+        chord_notes = self.chord_notes.tolist()
+        for i, duration in enumerate(self.chord_durations.tolist()):
+            yield tuple(chord_notes[chord_indptr[i]:chord_indptr[i + 1]]), duration
+        yield from self.new_chords
+
+    @property
+    def ids(self):
+        if self.id_dict is None:
+            self.id_dict = {chord_key: chord_id for chord_id, chord_key in enumerate(self)}
+        return self.id_dict
+
+    def intern(self, chord_key):
+        ids = self.ids
+        chord_id = ids.get(chord_key)
+        if chord_id is None:
+            chord_id = len(self)
+            ids[chord_key] = chord_id
+            self.new_chords.append(chord_key)
+        return chord_id
+
+    def to_arrays(self, size=None):
+        # (chord_indptr, chord_notes, chord_durations) of the first size chords:
+        # the notes of chord i are chord_notes[chord_indptr[i]:chord_indptr[i + 1]]
+        if size is None:
+            size = len(self)
+
+        nb_stored = len(self.chord_durations)
+        if size <= nb_stored:
+            return self.chord_indptr[:size + 1], self.chord_notes[:self.chord_indptr[size]], self.chord_durations[:size]
+
+        chords = self.new_chords[:size - nb_stored]
+        chord_indptr = numpy.concatenate([self.chord_indptr, self.chord_indptr[-1] + numpy.cumsum([len(notes) for notes, duration in chords], dtype=numpy.int64)])
+        chord_notes = numpy.concatenate([self.chord_notes, numpy.fromiter((note for notes, duration in chords for note in notes), dtype=numpy.int32)])
+        chord_durations = numpy.concatenate([self.chord_durations, numpy.array([duration for notes, duration in chords], dtype=numpy.int32)])
+        return chord_indptr, chord_notes, chord_durations
+
+    @staticmethod
+    def from_arrays(chord_indptr, chord_notes, chord_durations):
+        return Vocabulary(chord_indptr, chord_notes, chord_durations)
+
+    def note_range(self):
+        # (lowest, highest) note of every chord, computed on the arrays
+        chord_indptr, chord_notes, chord_durations = self.to_arrays()
+        if len(chord_durations) == 0:
+            return numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32)
+        return numpy.minimum.reduceat(chord_notes, chord_indptr[:-1]), numpy.maximum.reduceat(chord_notes, chord_indptr[:-1])
+
+    def to_chord(self, chord_id, time=0):
+        notes, duration = self[chord_id]
+        return Chord([Note(note, duration, time) for note in notes])
+
 class MarkovChain(dict):
-    def __init__(self, order):
+    def __init__(self, order, vocabulary=None):
         self.order = order
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
         self.durations = {}
+
+        # Counts of the transitions of order below self.order to the first
+        # self.order chords of every file, keyed by (context..., next). No full
+        # context reaches them, build_backoff adds them to the suffixes.
+        self.heads = {}
+
+        # The counts are the source of truth. Probabilities are derived per
+        # context when needed and dropped when update touches the row
+        self.probs = {}
+        self.duration_probs = {}
+
+    @staticmethod
+    def from_compiled(model):
+        # Back to counts from a compiled (or loaded) chain, to prune a saved
+        # model. CompiledChain.merged adds files without going through dicts.
+        chain = MarkovChain(model.order, model.vocabulary)
+
+        indptr = model.indptr.tolist()
+        successors = model.successors.tolist()
+        weights = model.weights.tolist()
+
+        for row, context in enumerate(map(tuple, model.contexts.tolist())):
+            start, end = indptr[row], indptr[row + 1]
+            chain[context] = dict(zip(successors[start:end], weights[start:end]))
+
+        duration_contexts, duration_indptr, duration_values, duration_weights = [array.tolist() for array in model.durations]
+        for row, context in enumerate(map(tuple, duration_contexts)):
+            start, end = duration_indptr[row], duration_indptr[row + 1]
+            chain.durations[context] = dict(zip(duration_values[start:end], duration_weights[start:end]))
+
+        chain.heads = compiled_heads(model)
+        return chain
     
     def update(self, chords):
-        i = self.order
+        nb_contexts = len(self)
 
-        while i < len(chords):
+        with metrics.span("count"):
+            chord_keys = chords_to_keys(chords)
+            chord_ids = [self.vocabulary.intern(chord_key) for chord_key in chord_keys]
+            durations = [duration for notes, duration in chord_keys]
+            count_heads(self.heads, chord_ids, self.order)
 
-            current_chord = chords[i]
-            previous_chords = []
+            for i in range(self.order, len(chords)):
 
-            for j in range(i - self.order, i):
-                previous_chords.append(chords[j])
-            
-            chords_note_key, chords_duration_key = chords_to_key(previous_chords)
-            current_chord_note_key, current_chord_duration_key = current_chord.to_key()
-            
+                # Contexts are tuples of the ids of the previous chords
+                context = tuple(chord_ids[i - self.order:i])
+                current_chord_id = chord_ids[i]
 
-            # Update markov chain for the notes of the chord
-            if chords_note_key not in self:
-                self[chords_note_key] = {}
+                # Update markov chain for the notes of the chord
+                if context not in self:
+                    self[context] = {}
            
-            if current_chord_note_key in self[chords_note_key]:
-                self[chords_note_key][current_chord_note_key] += 1
-            else:
-                self[chords_note_key][current_chord_note_key] = 1
+                if current_chord_id in self[context]:
+                    self[context][current_chord_id] += 1
+                else:
+                    self[context][current_chord_id] = 1
+
+                self.probs.pop(context, None)
             
-            # Update markov chain for the duration of the chord
-            if chords_duration_key not in self.durations:
-                self.durations[chords_duration_key] = {}
+                # Update markov chain for the duration of the chord
+                duration_context = tuple(durations[i - self.order:i])
+                current_duration = durations[i]
 
-            if current_chord_duration_key in self.durations[chords_duration_key]:
-                self.durations[chords_duration_key][current_chord_duration_key] += 1
-            else:
-                self.durations[chords_duration_key][current_chord_duration_key] = 1
+                if duration_context not in self.durations:
+                    self.durations[duration_context] = {}
+
+                if current_duration in self.durations[duration_context]:
+                    self.durations[duration_context][current_duration] += 1
+                else:
+                    self.durations[duration_context][current_duration] = 1
 
-            i += 1
+                self.duration_probs.pop(duration_context, None)
+
+        metrics.count("transitions", max(len(chords) - self.order, 0))
+        metrics.count("contexts", len(self) - nb_contexts)
         
-    def _chords_to_chain_key(self, chords):
-        key = ""
-        for chord in chords:
-            key += self._chord_to_chain_key(chord) + ":"
-        key = key[:-1]
-        return key
+    def merge(self, other):
+        # Add the counts of another (not yet normalized) chain to this one,
+        # translating its chord ids into this chain's vocabulary
+        if other.vocabulary is self.vocabulary:
+            id_map = range(len(self.vocabulary))
+        else:
+            id_map = [self.vocabulary.intern(chord_key) for chord_key in other.vocabulary]
+
+        for other_context in other:
+            context = tuple(id_map[chord_id] for chord_id in other_context)
+            if context not in self:
+                self[context] = {}
+            self.probs.pop(context, None)
+            for other_chord_id, count in other[other_context].items():
+                chord_id = id_map[other_chord_id]
+                if chord_id in self[context]:
+                    self[context][chord_id] += count
+                else:
+                    self[context][chord_id] = count
+
+        for key in other.durations:
+            if key not in self.durations:
+                self.durations[key] = {}
+            self.duration_probs.pop(key, None)
+            for next_key, count in other.durations[key].items():
+                if next_key in self.durations[key]:
+                    self.durations[key][next_key] += count
+                else:
+                    self.durations[key][next_key] = count
+
+        merge_heads(self.heads, other.heads, id_map)
+
+    def probabilities(self, context):
+        probs = self.probs.get(context)
+        if probs is None:
+            row = self[context]
+            total = sum(row.values())
+            probs = { x : row[x] / total for x in row }
+            self.probs[context] = probs
+        return probs
+
+    def duration_probabilities(self, context):
+        probs = self.duration_probs.get(context)
+        if probs is None:
+            row = self.durations[context]
+            total = sum(row.values())
+            probs = { x : row[x] / total for x in row }
+            self.duration_probs[context] = probs
+        return probs
+
+    def normalize_probs(self):
+        # Fill the probability cache of every row that is not up to date, the counts are left untouched
+        with metrics.span("normalize"):
+            for key in self:
+                self.probabilities(key)
+
+            for key in self.durations:
+                self.duration_probabilities(key)
+
+    def compile(self):
+        # Freeze the chain into flat arrays (one row per context, sorted by packed
+        # context key) with an alias table per row for O(1) sampling
+        with metrics.span("compile"):
+            contexts, indptr, successors, weights = table_to_arrays(self, self.order)
+            accept, alias = build_alias_tables(indptr, weights)
+
+            durations = table_to_arrays(self.durations, self.order)
+
+            model = CompiledChain(self.order, self.vocabulary, contexts, indptr, successors, weights, accept, alias, durations)
+            model.backoff = build_backoff(model, self.heads)
+            return model
+
+    def save(self, path):
+        self.compile().save(path)
+
+    def memory_size(self):
+        # Approximate bytes held by the counts: the dicts, their context tuples
+        # and the count objects (small ints are shared by the interpreter)
+        def table_size(table):
+            size = sys.getsizeof(table)
+            for context, row in table.items():
+                size += sys.getsizeof(context) + sys.getsizeof(row)
+                size += sum(sys.getsizeof(count) for count in row.values() if count > 256)
+            return size
+
+        return table_size(self) + table_size(self.durations)
+
+    def prune(self, min_count=1, top_k=None, max_bytes=None):
+        # Drops the transitions seen less than min_count times and keeps the
+        # top_k most frequent successors of every context, in both tables. Then
+        # the least frequent contexts are evicted until the counts fit in
+        # max_bytes. The dicts are rebuilt so the memory is given back.
+        # Returns a report of what was removed. Raises ValueError, with the
+        # chain left as it was, when min_count or top_k remove every transition.
+        with metrics.span("prune"):
+            bytes_before = self.memory_size()
+            total = sum(sum(row.values()) for row in self.values())
+            nb_contexts = len(self)
+            nb_transitions = sum(len(row) for row in self.values())
+
+            def prune_table(table):
+                rows = []
+                for context, row in table.items():
+                    items = [(successor, count) for successor, count in row.items() if count >= min_count]
+                    if top_k is not None and len(items) > top_k:
+                        items = sorted(items, key=lambda item: -item[1])[:top_k]
+                    if items:
+                        rows.append((context, dict(items) if len(items) < len(row) else row))
+                return rows
+
+            rows = prune_table(self)
+            if nb_contexts and not rows:
+                raise ValueError("Pruning with min_count " + str(min_count) + " and top_k " + str(top_k) + " would leave the chain empty")
+            duration_rows = prune_table(self.durations)
+
+            if max_bytes is not None:
+                # Every context costs its tuple, its dict, its counts and its slot
+                # in the table. Contexts of both tables are evicted together, but
+                # the most frequent chord context is always kept.
+                slot_size = 48
+
+                def row_size(context, row):
+                    return sys.getsizeof(context) + sys.getsizeof(row) + slot_size + sum(sys.getsizeof(count) for count in row.values() if count > 256)
+
+                tables = [rows, duration_rows]
+                entries = sorted((sum(row.values()), row_size(context, row), t, i) for t, table in enumerate(tables) for i, (context, row) in enumerate(table))
+                size = 2 * sys.getsizeof({}) + sum(entry[1] for entry in entries)
+
+                evicted = [set(), set()]
+                for row_total, entry_size, t, i in entries:
+                    if size <= max_bytes:
+                        break
+                    if t == 0 and len(evicted[0]) == len(rows) - 1:
+                        continue
+                    evicted[t].add(i)
+                    size -= entry_size
+
+                rows = [row for i, row in enumerate(rows) if i not in evicted[0]]
+                duration_rows = [row for i, row in enumerate(duration_rows) if i not in evicted[1]]
+
+            kept = sum(sum(row.values()) for context, row in rows)
+
+            self.clear()
+            dict.update(self, rows)
+            self.durations = dict(duration_rows)
+
+            # Cached rows may describe successors that are gone
+            self.probs = {}
+            self.duration_probs = {}
+
+            report = {
+                "contexts_removed": nb_contexts - len(self),
+                "transitions_removed": nb_transitions - sum(len(row) for row in self.values()),
+                "bytes_before": bytes_before,
+                "bytes_after": self.memory_size(),
+                "mass_dropped": (total - kept) / total if total else 0.0,
+            }
+
+        metrics.count("pruned_contexts", report["contexts_removed"])
+        metrics.count("pruned_transitions", report["transitions_removed"])
+        metrics.count("bytes_reclaimed", report["bytes_before"] - report["bytes_after"])
+
+        return report
+
+class SparseChain:
+    # Same counts as MarkovChain, stored as scipy.sparse CSR matrices (contexts x
+    # next states) instead of nested dicts. New transitions are kept as arrays
+    # and folded into the matrices the next time the counts are needed.
+    def __init__(self, order, vocabulary=None):
+        self.order = order
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+
+        self.contexts = numpy.zeros((0, order), dtype=numpy.int32)
+        self.counts = None
+        self.probs = None
+
+        # Columns of the duration matrix are indices into duration_values
+        self.duration_contexts = numpy.zeros((0, order), dtype=numpy.int32)
+        self.duration_values = numpy.zeros(0, dtype=numpy.int32)
+        self.duration_counts = None
+
+        self.pending = []
+        self.pending_durations = []
+
+        # Same as MarkovChain.heads
+        self.heads = {}
+
+    def update(self, chords):
+        with metrics.span("count"):
+            chord_keys = chords_to_keys(chords)
+            chord_ids = numpy.array([self.vocabulary.intern(chord_key) for chord_key in chord_keys], dtype=numpy.int64)
+            count_heads(self.heads, chord_ids.tolist(), self.order)
+            if len(chords) <= self.order:
+                return
+
+            durations = numpy.array([duration for notes, duration in chord_keys], dtype=numpy.int64)
+
+            # Row i of the windows is (context..., next state) for chord i + order
+            windows = numpy.lib.stride_tricks.sliding_window_view(chord_ids, self.order + 1)
+            self.pending.append((windows[:, :-1], windows[:, -1], numpy.ones(len(windows), dtype=numpy.int64)))
+
+            windows = numpy.lib.stride_tricks.sliding_window_view(durations, self.order + 1)
+            self.pending_durations.append((windows[:, :-1], windows[:, -1], numpy.ones(len(windows), dtype=numpy.int64)))
+
+        metrics.count("transitions", len(chords) - self.order)
+        self.probs = None
+
+    def merge(self, other):
+        if other.vocabulary is self.vocabulary:
+            id_map = numpy.arange(len(self.vocabulary))
+        else:
+            id_map = numpy.array([self.vocabulary.intern(chord_key) for chord_key in other.vocabulary], dtype=numpy.int64)
+
+        for contexts, next_states, weights in other.transitions():
+            self.pending.append((id_map[contexts], id_map[next_states], weights))
+
+        self.pending_durations += other.duration_transitions()
+        merge_heads(self.heads, other.heads, id_map.tolist())
+        self.probs = None
+
+    def transitions(self):
+        from sparse_chain import expand_rows
+
+        if self.counts is None:
+            return list(self.pending)
+        return [expand_rows(self.contexts, self.counts)] + self.pending
+
+    def duration_transitions(self):
+        from sparse_chain import expand_rows
+
+        if self.duration_counts is None:
+            return list(self.pending_durations)
+        contexts, columns, weights = expand_rows(self.duration_contexts, self.duration_counts)
+        return [(contexts, self.duration_values[columns], weights)] + self.pending_durations
+
+    def flush(self):
+        from sparse_chain import count_transitions
+
+        if self.pending:
+            contexts, next_states, weights = [numpy.concatenate(arrays) for arrays in zip(*self.transitions())]
+            self.contexts, self.counts = count_transitions(contexts, next_states, len(self.vocabulary), weights)
+            self.pending = []
+
+        if self.pending_durations:
+            contexts, values, weights = [numpy.concatenate(arrays) for arrays in zip(*self.duration_transitions())]
+            self.duration_values, columns = numpy.unique(values, return_inverse=True)
+            self.duration_contexts, self.duration_counts = count_transitions(contexts, columns.ravel(), len(self.duration_values), weights)
+            self.pending_durations = []
 
     def normalize_probs(self):
-        for key in self:
-            self[key] = { x : self[key][x] / sum(list(self[key].values())) for x in self[key] }
+        from sparse_chain import normalize_rows
+
+        with metrics.span("count"):
+            self.flush()
+
+        if self.probs is None and self.counts is not None:
+            with metrics.span("normalize"):
+                self.probs = normalize_rows(self.counts)
+
+    def compile(self):
+        self.normalize_probs()
+
+        with metrics.span("compile"):
+            accept, alias = build_alias_tables(self.counts.indptr, self.counts.data)
+
+            durations = (self.duration_contexts.astype(numpy.int32), self.duration_counts.indptr.astype(numpy.int64),
+                         self.duration_values[self.duration_counts.indices].astype(numpy.int32), self.duration_counts.data.astype(numpy.int64))
+
+            model = CompiledChain(self.order, self.vocabulary, self.contexts.astype(numpy.int32), self.counts.indptr.astype(numpy.int64),
+                                  self.counts.indices.astype(numpy.int32), self.counts.data.astype(numpy.int64), accept, alias, durations)
+            model.backoff = build_backoff(model, self.heads)
+            return model
+
+    def save(self, path):
+        self.compile().save(path)
+
+class CompiledChain:
+    def __init__(self, order, vocabulary, contexts, indptr, successors, weights, accept, alias, durations, keys=None):
+        self.order = order
+        self.vocabulary = vocabulary
+        self.vocabulary_size = len(vocabulary)
+        self.contexts = contexts
+        self.indptr = indptr
+        self.successors = successors
+        self.weights = weights
+        self.accept = accept
+        self.alias = alias
+
+        # (contexts, indptr, durations, weights) of the duration table
+        self.durations = durations
+
+        if keys is None:
+            keys = pack_contexts(contexts, self.vocabulary_size)
+        self.keys = keys
+
+        # Chains of order - 1 down to 0, see build_backoff
+        self.backoff = []
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def find_backoff_row(self, context):
+        # Row of the longest suffix of the context that was seen. Returns the chain
+        # holding it, the row, and the number of chords dropped from the context.
+        row = self.find_row(context)
+        if row >= 0:
+            return self, row, 0
+
+        for depth, chain in enumerate(self.backoff, 1):
+            row = chain.find_row(context[depth:])
+            if row >= 0:
+                return chain, row, depth
+
+        return None, -1, self.order
+
+    def find_row(self, context):
+        # Index of the row of a context, -1 if the context was never seen
+        key = pack_context(context, self.vocabulary_size)
+        row = int(self.keys.searchsorted(key))
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        return -1
+
+    def sample(self, row, u):
+        # One uniform number in [0, 1) picks both the alias column and the coin flip
+        start = self.indptr[row]
+        n = self.indptr[row + 1] - start
+        x = u * n
+        column = min(int(x), n - 1)
+        if x - column < self.accept[start + column]:
+            return int(self.successors[start + column])
+        return int(self.successors[self.alias[start + column]])
+
+    def find_rows(self, keys):
+        # Vectorised find_row on an array of packed context keys
+        rows = numpy.minimum(self.keys.searchsorted(keys), len(self.keys) - 1)
+        return numpy.where(self.keys[rows] == keys, rows, -1)
+
+    def find_context_rows(self, contexts):
+        # find_rows on a (n, order) array of contexts
+        return self.find_rows(pack_contexts(contexts, self.vocabulary_size))
+
+    def transition_rows(self):
+        # (context..., next) rows of every transition, sorted like the keys,
+        # and their weights
+        rows = numpy.repeat(numpy.arange(len(self)), numpy.diff(self.indptr))
+        return numpy.column_stack([self.contexts[rows], self.successors]).astype(numpy.int64), numpy.asarray(self.weights, dtype=numpy.int64)
+
+    def merged(self, other):
+        # New CompiledChain with the counts of other, a MarkovChain or
+        # SparseChain of the same order, added at every level. The counts are
+        # added in the arrays, and only the rows of the contexts other has seen
+        # get new alias tables. The chords of other are interned into this
+        # vocabulary.
+        added = other.compile()
+
+        with metrics.span("compile"):
+            id_map = numpy.array([self.vocabulary.intern(chord_key) for chord_key in added.vocabulary], dtype=numpy.int64)
+            durations = merge_durations(self.order, self.durations, added.durations)
+
+            def merge_level(chain, added_chain):
+                transitions, counts = added_chain.transition_rows()
+                return add_transitions(chain, id_map[transitions], counts, durations)
+
+            model = merge_level(self, added)
+            if len(self.backoff) == self.order:
+                model.backoff = [merge_level(chain, added_chain) for chain, added_chain in zip(self.backoff, added.backoff)]
+            else:
+                model.backoff = build_backoff(model)
+            return model
+
+    def sample_rows(self, rows, u):
+        # Vectorised sample, one uniform number per row
+        start = self.indptr[rows]
+        n = self.indptr[rows + 1] - start
+        x = u * n
+        column = numpy.minimum(x.astype(numpy.int64), n - 1)
+        index = start + column
+        return numpy.where(x - column < self.accept[index], self.successors[index], self.successors[self.alias[index]])
+
+    def save(self, path):
+        # One .npy file per array so that load_chain can memory-map them
+        os.makedirs(path, exist_ok=True)
+
+        arrays = {name: getattr(self, name) for name in CHAIN_ARRAYS}
+        arrays.update(zip(DURATION_ARRAYS, self.durations))
+        arrays.update(zip(VOCABULARY_ARRAYS, self.vocabulary.to_arrays(self.vocabulary_size)))
+
+        for depth, chain in enumerate(self.backoff, 1):
+            arrays.update(("backoff" + str(depth) + "_" + name, getattr(chain, name)) for name in CHAIN_ARRAYS)
+
+        # Through new files, the arrays may be memory-mapped from the old ones
+        for name, array in arrays.items():
+            with tempfile.NamedTemporaryFile(dir=path, suffix=".tmp", delete=False) as array_file:
+                numpy.save(array_file, array)
+            os.replace(array_file.name, os.path.join(path, name + ".npy"))
+
+CHAIN_ARRAYS = ["contexts", "keys", "indptr", "successors", "weights", "accept", "alias"]
+DURATION_ARRAYS = ["duration_contexts", "duration_indptr", "duration_values", "duration_weights"]
+VOCABULARY_ARRAYS = ["chord_indptr", "chord_notes", "chord_durations"]
+
+def load_chain(path, mmap=True):
+    mmap_mode = "r" if mmap else None
+
+    def load(name):
+        return numpy.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+    durations = tuple(load(name) for name in DURATION_ARRAYS)
+    vocabulary = Vocabulary.from_arrays(*[load(name) for name in VOCABULARY_ARRAYS])
+
+    def load_compiled(prefix):
+        arrays = {name: load(prefix + name) for name in CHAIN_ARRAYS}
+        return CompiledChain(arrays["contexts"].shape[1], vocabulary, arrays["contexts"], arrays["indptr"], arrays["successors"],
+                             arrays["weights"], arrays["accept"], arrays["alias"], durations, keys=arrays["keys"])
+
+    model = load_compiled("")
+
+    depth = 1
+    while os.path.exists(os.path.join(path, "backoff" + str(depth) + "_keys.npy")):
+        model.backoff.append(load_compiled("backoff" + str(depth) + "_"))
+        depth += 1
+
+    return model
+
+def build_backoff(model, heads=None):
+    # Chains of every order below model.order. The counts of order k are the
+    # suffixes of the transitions of the model plus the heads of that length
+    # (see MarkovChain.heads), which makes them the counts of an order k chain
+    # trained on the same files. backoff[depth - 1] is the chain of order
+    # model.order - depth, down to the order 0 chain that counts every chord.
+    return [transitions_to_chain(order, model.vocabulary, transitions, counts, model.durations)
+            for order, transitions, counts in lower_transitions(model, heads)]
+
+def lower_transitions(model, heads=None):
+    # (order, sorted unique (context..., next) rows, counts) of every order
+    # below model.order, from the suffixes of its transitions and the heads
+    vocabulary_size = model.vocabulary_size
+    model_transitions, weights = model.transition_rows()
+
+    for order in range(model.order - 1, -1, -1):
+        transitions = model_transitions[:, model.order - order:]
+        transition_weights = weights
+
+        level_heads = [(head, count) for head, count in (heads or {}).items() if len(head) == order + 1]
+        if level_heads:
+            transitions = numpy.vstack([transitions, numpy.array([head for head, count in level_heads], dtype=numpy.int64)])
+            transition_weights = numpy.append(weights, [count for head, count in level_heads])
+
+        index, inverse = numpy.unique(pack_contexts(transitions, vocabulary_size), return_index=True, return_inverse=True)[1:]
+        counts = numpy.bincount(inverse.ravel(), weights=transition_weights, minlength=len(index)).astype(numpy.int64)
+
+        yield order, transitions[index], counts
+
+def compiled_heads(model):
+    # The heads of a compiled chain: what its backoff chains count on top of
+    # the suffixes of its transitions
+    heads = {}
+    for chain, (order, transitions, counts) in zip(model.backoff, lower_transitions(model)):
+        chain_transitions, chain_weights = chain.transition_rows()
+
+        keys = pack_contexts(transitions, model.vocabulary_size)
+        chain_keys = pack_contexts(chain_transitions, model.vocabulary_size)
+        index = numpy.minimum(keys.searchsorted(chain_keys), max(len(keys) - 1, 0))
+        suffix_counts = numpy.where(keys[index] == chain_keys, counts[index], 0) if len(keys) else 0
+
+        extra = chain_weights - suffix_counts
+        for head, count in zip(map(tuple, chain_transitions[extra > 0].tolist()), extra[extra > 0].tolist()):
+            heads[head] = count
+    return heads
+
+def count_heads(heads, chord_ids, order):
+    # Transitions with a context of every length below order to the first order
+    # chords of a file, see MarkovChain.heads
+    for i in range(min(order, len(chord_ids))):
+        for length in range(i + 1):
+            head = tuple(chord_ids[i - length:i + 1])
+            heads[head] = heads.get(head, 0) + 1
+
+def merge_heads(heads, other_heads, id_map):
+    for other_head, count in other_heads.items():
+        head = tuple(id_map[chord_id] for chord_id in other_head)
+        heads[head] = heads.get(head, 0) + count
+
+def transitions_to_chain(order, vocabulary, transitions, counts, durations):
+    # CompiledChain of the sorted unique (context..., next) rows of transitions
+    # and their counts
+    keys, row_starts, indptr = csr_rows(transitions, order, len(vocabulary))
+    accept, alias = build_alias_tables(indptr, counts)
+
+    return CompiledChain(order, vocabulary, transitions[row_starts, :order].astype(numpy.int32), indptr, transitions[:, order].astype(numpy.int32),
+                         counts, accept, alias, durations, keys=keys)
+
+def csr_rows(transitions, order, base):
+    # Packed keys of the contexts of sorted (context..., next) rows, the index
+    # of the first row of every context, and the row pointers
+    context_keys = pack_contexts(transitions[:, :order], base)
+    row_starts = numpy.flatnonzero(numpy.concatenate([[len(context_keys) > 0], context_keys[1:] != context_keys[:-1]]))
+    indptr = numpy.append(row_starts, len(context_keys)).astype(numpy.int64)
+    return context_keys[row_starts], row_starts, indptr
+
+def add_transitions(chain, transitions, counts, durations):
+    # CompiledChain of the counts of chain plus the unique (context..., next)
+    # rows of transitions, over the vocabulary of chain which may have grown.
+    # The alias tables of the rows transitions do not touch are moved as is.
+    order = chain.order
+    vocabulary_size = len(chain.vocabulary)
+    old_transitions, old_counts = chain.transition_rows()
+    old_keys = pack_contexts(old_transitions, vocabulary_size)
+
+    keys = pack_contexts(transitions, vocabulary_size)
+    sort = numpy.argsort(keys, kind="stable")
+    keys, transitions, counts = keys[sort], transitions[sort], counts[sort]
+
+    position = old_keys.searchsorted(keys)
+    found = position < len(old_keys)
+    found[found] = old_keys[position[found]] == keys[found]
+
+    merged_counts = old_counts.copy()
+    merged_counts[position[found]] += counts[found]
+    merged_counts = numpy.insert(merged_counts, position[~found], counts[~found])
+    merged_transitions = numpy.insert(old_transitions, position[~found], transitions[~found], axis=0)
+
+    # Index of every old transition among the merged ones
+    moved = numpy.arange(len(old_keys)) + position[~found].searchsorted(numpy.arange(len(old_keys)), side="right")
+
+    context_keys, row_starts, indptr = csr_rows(merged_transitions, order, vocabulary_size)
+
+    accept = numpy.ones(len(merged_counts), dtype=numpy.float64)
+    alias = numpy.arange(len(merged_counts), dtype=numpy.int64)
+    accept[moved] = chain.accept
+    alias[moved] = moved[chain.alias]
+
+    touched = numpy.unique(context_keys.searchsorted(pack_contexts(transitions[:, :order], vocabulary_size)))
+    update_alias_tables(indptr, merged_counts, accept, alias, touched)
+
+    return CompiledChain(order, chain.vocabulary, merged_transitions[row_starts, :order].astype(numpy.int32), indptr,
+                         merged_transitions[:, order].astype(numpy.int32), merged_counts, accept, alias, durations, keys=context_keys)
+
+def merge_durations(order, durations, other_durations):
+    # Duration table (contexts, indptr, durations, weights) with the counts of both
+    transitions = []
+    weights = []
+    for contexts, indptr, values, value_weights in (durations, other_durations):
+        rows = numpy.repeat(numpy.arange(len(contexts)), numpy.diff(indptr))
+        transitions.append(numpy.column_stack([numpy.reshape(contexts, (len(contexts), order))[rows], values]).astype(numpy.int64))
+        weights.append(numpy.asarray(value_weights, dtype=numpy.int64))
+    transitions = numpy.concatenate(transitions)
+
+    base = int(transitions.max(initial=0)) + 1
+    index, inverse = numpy.unique(pack_contexts(transitions, base), return_index=True, return_inverse=True)[1:]
+    counts = numpy.bincount(inverse.ravel(), weights=numpy.concatenate(weights), minlength=len(index)).astype(numpy.int64)
+    transitions = transitions[index]
+
+    keys, row_starts, indptr = csr_rows(transitions, order, base)
+    return transitions[row_starts, :order].astype(numpy.int32), indptr, transitions[:, order].astype(numpy.int32), counts
+
+def table_to_arrays(table, order):
+    # CSR layout of a {context: {next: count}} table: a (rows, order) array of
+    # contexts, row pointers, and the next states and counts of every row. Rows
+    # and the next states within a row are sorted, like the CSR matrices of
+    # SparseChain.
+    contexts = sorted(table.keys())
+    rows = [sorted(table[context].items()) for context in contexts]
+
+    indptr = numpy.zeros(len(contexts) + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum([len(row) for row in rows])
+
+    successors = numpy.fromiter((x for row in rows for x, w in row), dtype=numpy.int32, count=indptr[-1])
+    weights = numpy.fromiter((w for row in rows for x, w in row), dtype=numpy.int64, count=indptr[-1])
+
+    return numpy.array(contexts, dtype=numpy.int32).reshape(len(contexts), order), indptr, successors, weights
+
+def pack_context(context, vocabulary_size):
+    if vocabulary_size ** len(context) >= 2 ** 63:
+        return pack_contexts(numpy.array(context, dtype=numpy.int64).reshape(1, len(context)), vocabulary_size)[0]
+
+    key = 0
+    for chord_id in context:
+        key = key * vocabulary_size + chord_id
+    return key
+
+def pack_contexts(contexts, vocabulary_size):
+    # Keys that sort like the rows of contexts: the chord ids as digits of an
+    # int64 in base vocabulary_size, or when that would overflow, the rows as
+    # big-endian int32 bytes in a void dtype, which numpy compares bytewise
+    if vocabulary_size ** contexts.shape[1] >= 2 ** 63:
+        return numpy.ascontiguousarray(contexts, dtype=">i4").view("V" + str(4 * contexts.shape[1])).reshape(len(contexts))
+
+    keys = numpy.zeros(len(contexts), dtype=numpy.int64)
+    for k in range(contexts.shape[1]):
+        keys = keys * vocabulary_size + contexts[:, k]
+    return keys
+
+def build_alias_tables(indptr, weights):
+    # Alias tables of every row of a CSR layout at once, for the probabilities
+    # weights / row total. Sweep of Hübschle-Schneider and Sanders: the light
+    # columns (n * p < 1) of a row are filled in order by its heavy columns, a
+    # heavy column gives until it drops below 1 and is then filled by the next
+    # heavy one. Column i is kept with probability accept[i], otherwise
+    # alias[i] (an index into weights) is returned. Every sum is taken within
+    # its row, so a row gets the same table whatever rows are built with it.
+    sizes = numpy.diff(indptr)
+    row_of = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    totals = numpy.bincount(row_of, weights=weights, minlength=len(sizes))
+    scaled = weights / totals[row_of] * sizes[row_of]
+
+    accept = numpy.ones(len(scaled), dtype=numpy.float64)
+    alias = numpy.arange(len(scaled), dtype=numpy.int64)
+
+    heavy = scaled >= 1.0
+    lights = numpy.flatnonzero(~heavy)
+    heavies = numpy.flatnonzero(heavy)
+    if len(heavies) == 0:
+        return accept, alias
+
+    light_starts = lights.searchsorted(indptr)
+    heavy_starts = heavies.searchsorted(indptr)
+    heavy_rows = row_of[heavies]
+
+    # Deficit of the light columns of the row up to each of them, and excess
+    # of the heavy columns of the row up to each of them
+    deficits = row_cumsum(1.0 - scaled[lights], light_starts)
+    excess = row_cumsum(scaled[heavies] - 1.0, heavy_starts)
+
+    # Light columns filled by the heavy ones up to each of them: up to the
+    # first whose deficit is more than their excess
+    first_light = light_starts[heavy_rows]
+    last_light = light_starts[heavy_rows + 1]
+    taken = numpy.minimum(search_rows(deficits, first_light, last_light, excess) + 1, last_light)
+    taken_deficit = numpy.where(taken > first_light, numpy.append(deficits, 0.0)[taken - 1], 0.0)
+
+    # Light columns that rounding left without a heavy one keep accept 1
+    light_heavy = numpy.minimum(taken.searchsorted(numpy.arange(len(lights)), side="right"), len(heavies) - 1)
+    filled = heavy_rows[light_heavy] == row_of[lights]
+    accept[lights[filled]] = scaled[lights[filled]]
+    alias[lights[filled]] = heavies[light_heavy[filled]]
+
+    # What is left of a heavy column, filled by the next heavy one of the row
+    remaining = excess + 1.0 - taken_deficit
+    has_next = (numpy.arange(1, len(heavies) + 1) < heavy_starts[heavy_rows + 1]) & (remaining < 1.0)
+    accept[heavies[has_next]] = numpy.maximum(remaining[has_next], 0.0)
+    alias[heavies[has_next]] = heavies[numpy.flatnonzero(has_next) + 1]
+
+    return accept, alias
+
+def search_rows(values, starts, ends, queries):
+    # values.searchsorted(queries[i], side="right") within values[starts[i]:ends[i]],
+    # a binary search of every query at once
+    low = starts.copy()
+    high = ends.copy()
+
+    active = numpy.flatnonzero(low < high)
+    while len(active):
+        middle = (low[active] + high[active]) // 2
+        right = values[middle] <= queries[active]
+        low[active[right]] = middle[right] + 1
+        high[active[~right]] = middle[~right]
+        active = active[low[active] < high[active]]
+
+    return low
+
+def row_cumsum(values, indptr):
+    # Cumulative sums restarted on every row of a CSR layout. Rows are padded
+    # to the next power of two of their size and summed as 2D arrays, so the
+    # sums of a row never depend on the other rows.
+    sizes = numpy.diff(indptr)
+    sums = numpy.zeros(len(values), dtype=numpy.float64)
+    widths = numpy.ceil(numpy.log2(numpy.maximum(sizes, 1))).astype(numpy.int64)
+
+    for width in numpy.unique(widths[sizes > 0]).tolist():
+        rows = numpy.flatnonzero((widths == width) & (sizes > 0))
+        columns = numpy.arange(1 << width)
+        mask = columns < sizes[rows, None]
+        entries = (indptr[rows, None] + columns)[mask]
+
+        padded = numpy.zeros(mask.shape, dtype=numpy.float64)
+        padded[mask] = values[entries]
+        sums[entries] = numpy.cumsum(padded, axis=1)[mask]
+
+    return sums
+
+def update_alias_tables(indptr, weights, accept, alias, rows):
+    # Rebuilds the alias tables of the given rows in place
+    sizes = numpy.diff(indptr)[rows]
+    row_indptr = numpy.concatenate([[0], numpy.cumsum(sizes)])
+    entries = numpy.arange(row_indptr[-1]) + numpy.repeat(indptr[rows] - row_indptr[:-1], sizes)
+
+    row_accept, row_alias = build_alias_tables(row_indptr, weights[entries])
+    accept[entries] = row_accept
+    alias[entries] = entries[row_alias]
+
+# Parsed notes are stored column-wise in arrays of this dtype, times in ticks at TICKS_PER_BEAT
+NOTE_DTYPE = numpy.dtype([("pitch", numpy.int16), ("onset", numpy.int64), ("duration", numpy.int64), ("track", numpy.int16)])
+
+class ChordSequence:
+    # The chords of a file: notes is a NOTE_DTYPE array sorted by onset and the
+    # notes of chord i are notes[offsets[i]:offsets[i + 1]]. Indexing it builds
+    # a Chord for that slice only, nothing is kept per chord.
+    __slots__ = ("notes", "offsets")
+
+    def __init__(self, notes, offsets):
+        self.notes = notes
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chord index out of range")
+        notes = self.notes[self.offsets[i]:self.offsets[i + 1]]
+        return Chord([Note(pitch, duration, onset) for pitch, onset, duration in zip(notes["pitch"].tolist(), notes["onset"].tolist(), notes["duration"].tolist())])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def keys(self):
+        # Chord.to_key of every chord, computed on the columns
+        if len(self) == 0:
+            return []
 
-        for key in self.durations:
-            self.durations[key] = { x : self.durations[key][x] / sum(list(self.durations[key].values())) for x in self.durations[key] }
+        offsets = self.offsets.tolist()
+        pitches = self.notes["pitch"].tolist()
+        sizes = numpy.diff(self.offsets)
+        mean_durations = (numpy.add.reduceat(self.notes["duration"], self.offsets[:-1]) // sizes).tolist()
+
+        return [(tuple(pitches[offsets[i]:offsets[i + 1]]), mean_durations[i]) for i in range(len(mean_durations))]
+
+def chords_to_keys(chords):
+    if isinstance(chords, ChordSequence):
+        return chords.keys()
+    return [chord.to_key() for chord in chords]
 
 class Chord:
+    __slots__ = ("notes",)
+
     def __init__(self, notes):
         self.notes = notes
 
@@ -68,29 +930,22 @@ class Chord:
         formatted_string = str(len(self.notes)) + " notes "
 
         for note in self.notes:
-            formatted_string += " | " + str(note.note) + " , " + str(note.duration) + " , " + str(round(note.time, 2))
+            formatted_string += " | " + str(note.note) + " , " + str(note.duration) + " , " + str(note.time)
 
         formatted_string += " |"
 
         return formatted_string
 
     def to_key(self):
-        chord_key = ""
-        duration_key = str(self.get_mean_duration())
-        for note in self.notes:
-            chord_key += str(note.note) + ","
-        chord_key = chord_key[:-1] + "|" + duration_key
-        return chord_key, duration_key
-
-    def from_key_str(self, key):
-        chords_str = key.split(":")
-        print(chords_str)
+        return tuple(note.note for note in self.notes), self.get_mean_duration()
 
     def get_mean_duration(self):
         mean = sum([note.duration for note in self.notes]) / len(self.notes)
         return int(mean)
 
 class Note:
+    __slots__ = ("note", "duration", "time")
+
     def __init__(self, note, duration, time):
         self.note = int(note)
         self.duration = int(duration)
@@ -106,17 +961,6 @@ def add_to_dict(dict, key, element):
         dict[key] = {}
         dict[key][element] = 1
 
-def chords_to_key(chords):
-    note_key = ""
-    duration_key = ""
-    for chord in chords:
-        chord_note_key, chord_duration_key = chord.to_key()
-        note_key += chord_note_key + ":"
-        duration_key += chord_duration_key + ":"
-    note_key = note_key[:-1]
-    duration_key = duration_key[:-1]
-    return note_key, duration_key
-
 def clean_track(track, events_to_keep):
     track[:] = [msg for msg in track if msg.type in events_to_keep]
     return track
@@ -128,120 +972,165 @@ def print_track(track):
         print(msg)
     print("------------------")
 
-def read_midi(file_name):
-    print("Reading file : ", file_name)
-    midi = MidiFile(file_name)
-
-    print("Ticks per second: ", midi.ticks_per_beat)
-    notes = []
-
-    for i, track in enumerate(midi.tracks):
-
-        current_time = 0
-        notes_only_track = clean_track(track, ["note_on", "note_off"])
-
-        for i, msg in enumerate(notes_only_track):
-
-            current_time += msg.time / midi.ticks_per_beat * 10
-
-            if msg.type == "note_on" and msg.velocity != 0:
-
-                current_note = msg.note
-                current_note_start_time = current_time
-                current_note_stop_time = current_note_start_time
-
-                for j, msg2 in enumerate(notes_only_track[i+1:]):
-
-                    current_note_stop_time += msg2.time / midi.ticks_per_beat * 10
-
-                    if (msg2.note == current_note and msg2.type == "note_off") or \
-                       (msg2.note == current_note and msg2.type == "note_on" and msg2.velocity == 0):
-
-                        notes.append(Note(current_note, current_note_stop_time - current_note_start_time, current_note_start_time))
-                        break
-
-    print("Number of notes: ", len(notes))
-    chords = notes_to_chords(notes)
-    
-    return chords
-
-def notes_to_chords(notes):
-
-    chords = []
-
-    i = 0
-    while i < len(notes):
-
-        current_note = notes[i]
-        current_chord = Chord([current_note])
-        j = i + 1
-
-        if j < len(notes):
-
-            next_note = notes[j]
+def rescale_ticks(ticks, ticks_per_beat):
+    # Ticks of a file at ticks_per_beat to TICKS_PER_BEAT, rounded to the nearest tick
+    return (2 * ticks * TICKS_PER_BEAT + ticks_per_beat) // (2 * ticks_per_beat)
+
+def pair_notes(events, ticks_per_beat, track_index=0):
+    # (pitch, onset, duration, track) of every note of a track given as an
+    # smf.EVENT_DTYPE array, in note_on order
+    starts = []
+    ends = []
+    pitches = []
+
+    # Notes still sounding, keyed by (channel, pitch). Each key holds a FIFO of
+    # indices in starts, so overlapping re-strikes of the same pitch are closed
+    # in the order they were struck.
+    active_notes = {}
+
+    for tick, event_type, channel, pitch, velocity in zip(events["tick"].tolist(), events["type"].tolist(), events["channel"].tolist(),
+                                                         events["pitch"].tolist(), events["velocity"].tolist()):
+        key = (channel, pitch)
+
+        if event_type == NOTE_ON and velocity != 0:
+            active_notes.setdefault(key, []).append(len(starts))
+
+            # Notes stay in note_on order, the end is filled in once they are closed
+            starts.append(tick)
+            ends.append(-1)
+            pitches.append(pitch)
+
+        elif key in active_notes:
+            index = active_notes[key].pop(0)
+            if not active_notes[key]:
+                del active_notes[key]
+            ends[index] = tick
+
+    # Notes that never receive a note_off are dropped
+    ends = numpy.array(ends, dtype=numpy.int64)
+    closed = ends >= 0
+
+    notes = numpy.zeros(int(closed.sum()), dtype=NOTE_DTYPE)
+    notes["pitch"] = numpy.array(pitches, dtype=numpy.int16)[closed]
+    notes["onset"] = rescale_ticks(numpy.array(starts, dtype=numpy.int64)[closed], ticks_per_beat)
+    notes["duration"] = rescale_ticks(ends[closed], ticks_per_beat) - notes["onset"]
+    notes["track"] = track_index
+    return notes
+
+def read_midi(file_name, chord_window=0, normalize_key=False, cache=None):
+    # With normalize_key the notes are transposed to C major / A minor, using the
+    # key signature of the file or, when there is none, the detected key. cache
+    # is an optional parse_cache.ParseCache the chords are read from and saved to.
+    if cache is not None:
+        params = (chord_window, normalize_key, TICKS_PER_BEAT)
+        with metrics.span("cache"):
+            entry = cache.get(file_name, params, ("notes", "offsets"))
+
+        if entry is not None:
+            metrics.log("Cached file : ", file_name)
+            chords = ChordSequence(entry["notes"], entry["offsets"])
+
+            metrics.count("cache_hits")
+            metrics.count("files")
+            metrics.count("notes", len(chords.notes))
+            metrics.count("chords", len(chords))
+            return chords
+
+        metrics.count("cache_misses")
+
+    metrics.log("Reading file : ", file_name)
+
+    with metrics.span("parse"):
+        ticks_per_beat, tracks, key_signature = read_note_events(file_name)
+
+        metrics.log("Ticks per second: ", ticks_per_beat)
+
+        notes = numpy.concatenate([pair_notes(events, ticks_per_beat, i) for i, events in enumerate(tracks)] +
+                                  [numpy.zeros(0, dtype=NOTE_DTYPE)])
+
+    metrics.log("Number of notes: ", len(notes))
+
+    if normalize_key and len(notes):
+        with metrics.span("key"):
+            if key_signature is not None:
+                tonic, minor = key_signature
+            else:
+                tonic, minor = key.detect_key(notes["pitch"], notes["duration"])
 
-            while current_note.time == next_note.time:
+            notes["pitch"] = key.transpose(notes["pitch"], key.shift_to_canonical(tonic, minor))
 
-                current_chord.add_note(next_note)
+        metrics.log("Key : ", tonic, "minor" if minor else "major", "(signature)" if key_signature is not None else "(detected)")
 
-                if j + 1 < len(notes):
-                    j += 1
-                    next_note = notes[j]
-                else:
-                    break
+    # All the tracks are merged into a single stream ordered by onset
+    with metrics.span("chords"):
+        chords = notes_to_chords(notes, chord_window)
 
-        chords.append(current_chord)
+    metrics.count("files")
+    metrics.count("notes", len(notes))
+    metrics.count("chords", len(chords))
 
-        i = i + len(current_chord.notes)
+    if cache is not None:
+        with metrics.span("cache"):
+            cache.put(file_name, params, notes=chords.notes, offsets=chords.offsets)
 
     return chords
 
-def create_midi_data(markov_chain, nb_notes=100):
-    generated_chords = []
-
-    current_time = 0
-
-    # choose random chords (number of the markov chain order) for the start of the midi
-    random_start = numpy.random.choice(list(markov_chain.keys())).split("|")[0]
-    random_duration = numpy.random.choice(list(markov_chain.keys())).split("|")[1]
-    #random_duration = numpy.random.choice(list(markov_chain.durations.keys()))
-
-    for chord_name, duration in zip(random_start.split(":"), random_duration.split(":")):
-
-        generated_chords.append(name_to_chord(chord_name, int(duration), current_time))
-        current_time += float(duration)
-
-    for i in range(markov_chain.order, nb_notes):
-        previous_chords = []
-        
-        for j in range(i - markov_chain.order, i):
-            previous_chords.append(generated_chords[j])
-        
-        note_key, duration_key = chords_to_key(previous_chords)
-        
-        try:
-            next_chord = numpy.random.choice(list(markov_chain[note_key].keys()), p=list(markov_chain[note_key].values())).split("|")[0]
-            next_duration = numpy.random.choice(list(markov_chain[note_key].keys()), p=list(markov_chain[note_key].values())).split("|")[1]
-            #next_duration = numpy.random.choice(list(markov_chain.durations[duration_key].keys()), p=list(markov_chain.durations[duration_key].values()))
-        except KeyError as err:
-            print("Choosing random chord for : ", i)
-            next_chord = numpy.random.choice(list(markov_chain.keys())).split(":")[-1].split("|")[0]
-            next_duration = numpy.random.choice(list(markov_chain.keys())).split(":")[-1].split("|")[1]
-            #next_duration = numpy.random.choice(list(markov_chain.durations.keys())).split(":")[-1]
-
-        generated_chords.append(name_to_chord(next_chord, int(next_duration), current_time))
-        current_time += float(next_duration)
-
-    return generated_chords
-
-def name_to_chord(name, duration, time):
-    notes_name = name.split(",")
-    notes = []
-
-    for note in notes_name:
-        notes.append(Note(note, duration, time)) 
-    
-    return Chord(notes)
+def notes_to_chords(notes, window=0):
+    # notes is a NOTE_DTYPE array. Notes whose onsets are at most window ticks
+    # after the first onset of the chord are grouped in it, so a run of close
+    # onsets is cut into chords at most window ticks wide instead of chaining
+    # into one. The sort is stable, so notes struck together keep their track
+    # order.
+    notes = notes[numpy.argsort(notes["onset"], kind="stable")]
+    onsets = notes["onset"]
+
+    if window == 0:
+        chord_starts = (numpy.flatnonzero(numpy.diff(onsets)) + 1).tolist()
+    else:
+        # One search per chord for the first onset past its window
+        chord_starts = []
+        start = int(onsets.searchsorted(onsets[0] + window, side="right")) if len(onsets) else 0
+        while start < len(onsets):
+            chord_starts.append(start)
+            start = int(onsets.searchsorted(onsets[start] + window, side="right"))
+
+    offsets = numpy.array([0] + chord_starts + [len(notes)]) if len(notes) else numpy.zeros(1)
+
+    return ChordSequence(notes, offsets.astype(numpy.int64))
+
+def count_midi_file(args):
+    # Runs in a worker process, the metrics of the file are sent back with its counts
+    file_name, order, chain_class, chord_window, normalize_key, cache, metrics_enabled = args
+    metrics.enable(metrics_enabled)
+    metrics.reset()
+
+    chain = chain_class(order)
+    chain.update(read_midi(file_name, chord_window, normalize_key, cache))
+    return chain, metrics.report()
+
+def train_chain(file_names, order, jobs=1, chain_class=MarkovChain, chord_window=0, normalize_key=False, cache=None):
+    # chain_class is MarkovChain or SparseChain
+    chain = chain_class(order)
+
+    if jobs == 1:
+        for midi_file in file_names:
+            chain.update(read_midi(midi_file, chord_window, normalize_key, cache))
+        return chain
+
+    # Each worker parses a file and counts its transitions in a partial chain,
+    # the partial chains are merged back in file order. The cache is bounded
+    # once all the workers are done.
+    worker_cache = cache.deferred() if cache is not None else None
+    with Pool(jobs) as pool:
+        for partial_chain, partial_metrics in pool.imap(count_midi_file, [(midi_file, order, chain_class, chord_window, normalize_key, worker_cache, metrics.enabled)
+                                                                         for midi_file in file_names]):
+            chain.merge(partial_chain)
+            metrics.merge(partial_metrics)
+
+    if cache is not None:
+        cache.evict()
+
+    return chain
 
 def write_chord(track, chord):
     for note in chord.notes:
@@ -260,9 +1149,9 @@ def write_chord(track, chord):
         i += 1
 
 
-def write_midi(file_name, chords, instrument=0):
+def write_midi(file_name, chords, instrument=0, vocabulary=None, transpose=0):
     generated_midi = MidiFile()
-    generated_midi.ticks_per_beat = 10
+    generated_midi.ticks_per_beat = TICKS_PER_BEAT
 
     track = MidiTrack()
     generated_midi.tracks.append(track)
@@ -270,11 +1159,18 @@ def write_midi(file_name, chords, instrument=0):
     track.append(Message('program_change', program=instrument, channel=0, time=0))
     track.append(Message('control_change', control=10, channel=0, value=64, time=0))
 
-    for chord in chords:
-        write_chord(track, chord)
+    with metrics.span("write"):
+        for chord in chords:
+            if vocabulary is not None:
+                chord = vocabulary.to_chord(chord)
+            if transpose:
+                chord = Chord([Note(pitch, note.duration, note.time) for note, pitch in zip(chord.notes, key.transpose([note.note for note in chord.notes], transpose).tolist())])
+            write_chord(track, chord)
+
+        generated_midi.save(file_name)
 
-    generated_midi.save(file_name)
-    print("Midi file : ", file_name)
+    metrics.count("bytes_written", os.path.getsize(file_name))
+    metrics.log("Midi file : ", file_name)
 
 def pretty(d, indent=0):
    for key, value in d.items():
@@ -284,28 +1180,100 @@ def pretty(d, indent=0):
       else:
          print('\t' * (indent+2) + str(value))
 
-def run(command):
-    print(command)
-
-    import os
-    os.system(command)
-
 if __name__ == "__main__":  
-    chain = MarkovChain(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", help="glob of the midi files to train on (added to the loaded chain with --load)")
+    parser.add_argument("--order", type=int, default=1, help="order of the markov chain")
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes used to read the midi files")
+    parser.add_argument("--load", help="directory of a saved chain to generate from instead of training")
+    parser.add_argument("--save", help="directory to save the trained chain to")
+    parser.add_argument("--chord-window", type=int, default=0, help="notes starting at most this many ticks (at 10 per beat) after the first note of a chord join it")
+    parser.add_argument("--normalize-key", action="store_true", help="transpose every file to C major / A minor before counting")
+    parser.add_argument("--key", help="key to transpose the generated pieces to from C major / A minor, e.g. D or Bm")
+    parser.add_argument("--sparse", action="store_true", help="count the transitions in scipy.sparse matrices instead of dicts")
+    parser.add_argument("--min-count", type=int, default=1, help="drop the transitions seen fewer times")
+    parser.add_argument("--top-k", type=int, help="keep only the k most frequent successors of every context")
+    parser.add_argument("--max-memory", type=float, help="evict the least frequent contexts until the counts fit in this many MB")
+    parser.add_argument("--cache", help="directory of the cache of parsed midi files")
+    parser.add_argument("--cache-size", type=int, default=1024, help="maximum size of the parse cache in MB")
+    parser.add_argument("--pieces", type=int, default=1, help="number of pieces to generate")
+    parser.add_argument("--structure", default="ABACABA", help="sections of every piece, see structure.py")
+    parser.add_argument("--length", type=int, default=100, help="chords per section")
+    parser.add_argument("--render-command", default=DEFAULT_COMMAND, help="command rendering {midi} to {output}")
+    parser.add_argument("--render-format", default="pdf", help="format of the rendered scores")
+    parser.add_argument("--render-workers", type=int, default=2, help="number of scores rendered at the same time")
+    parser.add_argument("--render-timeout", type=float, default=120, help="seconds before a render is killed")
+    parser.add_argument("--verbose", action="store_true", help="print progress messages")
+    parser.add_argument("--metrics", help="save timings and counters to this json file")
+    args = parser.parse_args()
+
+    metrics.set_verbose(args.verbose)
+    metrics.enable(args.metrics is not None)
+
+    cache = ParseCache(args.cache, args.cache_size << 20) if args.cache else None
+
+    prune = args.min_count > 1 or args.top_k is not None or args.max_memory is not None
+    if prune and args.sparse:
+        parser.error("--min-count, --top-k and --max-memory need the dict chain")
+
+    def prune_chain(chain):
+        try:
+            report = chain.prune(args.min_count, args.top_k, None if args.max_memory is None else int(args.max_memory * 1e6))
+        except ValueError as err:
+            parser.error(str(err))
+        metrics.log("Pruned : ", report["contexts_removed"], "contexts,", report["transitions_removed"], "transitions,",
+                    "{:.1f} MB reclaimed, {:.2%} of the mass dropped".format((report["bytes_before"] - report["bytes_after"]) / 1e6, report["mass_dropped"]))
+
+    if args.load:
+        model = load_chain(args.load)
+
+        if args.files:
+            added = train_chain(glob.glob(args.files), model.order, jobs=args.jobs, chord_window=args.chord_window,
+                                normalize_key=args.normalize_key, cache=cache)
+            if prune:
+                # Pruning works on the dict counts of the whole chain
+                chain = MarkovChain.from_compiled(model)
+                chain.merge(added)
+                prune_chain(chain)
+                model = chain.compile()
+            else:
+                model = model.merged(added)
+    else:
+        chain_class = SparseChain if args.sparse else MarkovChain
+        chain = train_chain(glob.glob(args.files or "data/satie_gymnopedie_no1.mid"), args.order, jobs=args.jobs, chain_class=chain_class,
+                            chord_window=args.chord_window, normalize_key=args.normalize_key, cache=cache)
 
-    for midi_file in glob.glob("data/satie_gymnopedie_no1.mid"): 
-        chords = read_midi(midi_file)
-        chain.update(chords)
+        if prune:
+            prune_chain(chain)
 
-    chain.normalize_probs()
+        chain.normalize_probs()
+        model = chain.compile()
+
+    if args.save:
+        model.save(args.save)
     
-    for i in range(1):
-        piece = []
-        sec_a = create_midi_data(chain, 100)
-        sec_b = create_midi_data(chain, 100)
-        sec_c = create_midi_data(chain, 100)
-        piece += sec_a + sec_b + sec_a + sec_c + sec_a + sec_b + sec_a
-
-        name = "gen/gen" + str(i)
-        write_midi(name + ".mid", piece, instrument=0)
-        run("mscore \"" + name + ".mid\" -o \"" + name + ".pdf\"")
+    items = parse_structure(args.structure)
+    transpose = key.shift_from_canonical(*key.parse_key(args.key)) if args.key else 0
+
+    # Scores are rendered in the background while the next pieces are written
+    with RenderQueue(args.render_command, workers=args.render_workers, timeout=args.render_timeout) as render_queue:
+
+        backoff_depths = [0] * (model.order + 1)
+        for i in range(args.pieces):
+            sections = generate_sections(model, items, args.length, backoff_depths=backoff_depths)
+
+            name = "gen/gen" + str(i)
+            write_structured_midi(name + ".mid", items, sections, model.vocabulary, instrument=0, ticks_per_beat=TICKS_PER_BEAT,
+                                  transpose=transpose)
+            render_queue.submit(name + ".mid", args.render_format)
+
+        metrics.log("Chords generated per backoff depth : ", backoff_depths)
+
+        for result in render_queue.results():
+            if result.timed_out:
+                print("Render timed out : ", result.midi)
+            elif result.returncode != 0:
+                print("Render failed : ", result.midi, result.returncode, result.stderr)
+
+    if args.metrics:
+        metrics.save_report(args.metrics)